@@ -0,0 +1,293 @@
+"""End to end benchmark of a transcript export, without touching discord or the real bucket.
+
+Discord's REST API is replaced by a fake HTTPClient serving synthetic
+channels, the CDN by a local aiohttp server, and the bucket by a local S3
+stand-in: moto's server by default (`pip install "moto[server]"`), or any
+S3 compatible endpoint given with --s3-endpoint (e.g. a minio container).
+
+Run with `poetry run python benchmarks/export.py [options]`, and once more
+to measure an incremental export against the same bucket (--runs 2).
+Reports wall time, requests per endpoint, bytes moved and peak RSS.
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import hashlib
+import random
+import resource
+import socket
+import tempfile
+import time
+import types
+
+import aiohttp.web
+import botocore.exceptions
+import discord
+import discord.state
+
+from organizers_bot import config, ratelimit
+from organizers_bot.transcript import Transcript, TranscriptManager
+
+DISCORD_EPOCH = 1420070400000
+BUCKET = "bench"
+
+def snowflake(ms: int, idx: int = 0) -> int:
+    return ((ms - DISCORD_EPOCH) << 22) | (idx & 0x3FFFFF)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class Counters:
+    def __init__(self) -> None:
+        self.requests: collections.Counter[str] = collections.Counter()
+        self.bytes: collections.Counter[str] = collections.Counter()
+
+class FakeHTTP:
+    """The parts of discord.http.HTTPClient an export uses, serving synthetic channels."""
+    def __init__(self, channels: dict[int, list[dict]], counters: Counters, latency: float) -> None:
+        self.channels = channels
+        self.counters = counters
+        self.latency = latency
+
+    async def get_channel(self, channel_id: int) -> dict:
+        self.counters.requests["discord get_channel"] += 1
+        await asyncio.sleep(self.latency)
+        messages = self.channels.get(channel_id)
+        data = {"id": str(channel_id), "type": 0 if messages is not None else 4, "name": f"channel-{channel_id}"}
+        if messages:
+            data["last_message_id"] = messages[-1]["id"]
+        return data
+
+    async def logs_from(self, channel_id: int, limit: int, before=None, after=None, around=None) -> list[dict]:
+        self.counters.requests["discord logs_from"] += 1
+        await asyncio.sleep(self.latency)
+        messages = self.channels[channel_id]
+        after = int(after or 0)
+        # messages are sorted by id, find the first one after the snowflake
+        lo, hi = 0, len(messages)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if int(messages[mid]["id"]) <= after:
+                lo = mid + 1
+            else:
+                hi = mid
+        # discord returns pages newest first
+        return messages[lo:lo + limit][::-1]
+
+class FakeChannel:
+    def __init__(self, state: discord.state.ConnectionState, channel_id: int) -> None:
+        self._state = state
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+
+class FakeStatusChannel:
+    """Swallows the status messages of the export."""
+    id = 1
+
+    async def send(self, content: str):
+        return types.SimpleNamespace(channel=self, edit=self.edit)
+
+    async def edit(self, content: str):
+        pass
+
+def user(idx: int) -> dict:
+    return {
+        "id": str(10**17 + idx),
+        "username": f"player{idx}",
+        "avatar": f"{idx:032x}",
+        "discriminator": f"{idx % 10000:04}",
+        "public_flags": 0,
+    }
+
+def make_channels(args, cdn: str, rng: random.Random) -> dict[int, list[dict]]:
+    start = int(time.time() * 1000) - 30 * 24 * 3600 * 1000
+    channels = {}
+    for c in range(args.channels):
+        channel_id = snowflake(start, c)
+        messages = []
+        for m in range(args.messages):
+            # spread the messages out over a month
+            ms = start + 1 + m * (30 * 24 * 3600 * 1000 // args.messages)
+            msg_id = snowflake(ms, c)
+            msg = {
+                "id": str(msg_id),
+                "type": 0,
+                "channel_id": str(channel_id),
+                "author": user(rng.randrange(args.users)),
+                "content": "".join(rng.choice("abcdefghij klmnop") for _ in range(rng.randrange(20, 200))),
+                "timestamp": "2021-06-01T12:00:00.000000+00:00",
+                "edited_timestamp": None,
+                "tts": False,
+                "mention_everyone": False,
+                "mentions": [],
+                "mention_roles": [],
+                "pinned": False,
+                "flags": 0,
+                "attachments": [],
+                "embeds": [],
+            }
+            if rng.random() < args.attachments:
+                url = f"{cdn}/attachments/{channel_id}/{msg_id}/file.bin"
+                msg["attachments"] = [{
+                    "id": str(msg_id),
+                    "filename": "file.bin",
+                    "size": args.attachment_size,
+                    "url": url,
+                    "proxy_url": url,
+                }]
+            if rng.random() < args.embeds:
+                thumbnail = f"{cdn}/external/{msg_id}/thumbnail.png"
+                msg["embeds"] = [{
+                    "type": "link",
+                    "url": f"https://example.com/{msg_id}",
+                    "title": "Some writeup",
+                    "thumbnail": {"url": thumbnail, "proxy_url": thumbnail, "width": 400, "height": 300},
+                }]
+            messages.append(msg)
+        channels[channel_id] = messages
+    return channels
+
+def cdn_app(args, counters: Counters) -> aiohttp.web.Application:
+    contents: dict[str, bytes] = {}
+
+    async def serve(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        kind = request.path.split("/")[1]
+        counters.requests[f"cdn {kind}"] += 1
+        if request.path not in contents:
+            size = args.attachment_size if kind == "attachments" else args.small_size
+            # Distinct content per path, so every asset is really stored
+            seed = hashlib.sha1(request.path.encode()).digest()
+            contents[request.path] = (seed * (size // len(seed) + 1))[:size]
+        body = contents[request.path]
+        counters.bytes["cdn"] += len(body)
+        return aiohttp.web.Response(body=body, content_type="application/octet-stream")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/{tail:.*}", serve)
+    return app
+
+@contextlib.contextmanager
+def local_s3(endpoint):
+    if endpoint is not None:
+        yield endpoint
+        return
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise SystemExit('Install moto with `pip install "moto[server]"`, or pass --s3-endpoint')
+    port = free_port()
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.stop()
+
+async def prepare_bucket(mgr: TranscriptManager):
+    async with mgr.open_s3() as s3:
+        try:
+            await s3.create_bucket(Bucket=BUCKET)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] not in ("BucketAlreadyOwnedByYou", "BucketAlreadyExists"):
+                raise
+        # Like the real bucket, replacing objects leaves old versions around
+        await s3.put_bucket_versioning(Bucket=BUCKET, VersioningConfiguration={"Status": "Enabled"})
+
+async def export(mgr: TranscriptManager, category, counters: Counters):
+    async with mgr.open_s3() as s3:
+        def count(model, **kwargs):
+            counters.requests[f"s3 {model.name}"] += 1
+        s3.meta.events.register("before-call.s3", count)
+        await mgr.inventory.refresh(s3, config.s3.bucket_name)
+        trans = Transcript(mgr, category, FakeStatusChannel())
+        try:
+            await trans.build(s3)
+            await trans.finish_deferred(s3)
+        finally:
+            trans.cancel_deferred()
+            mgr.inventory.save()
+
+async def run(args, s3_endpoint: str, workdir: str):
+    counters = Counters()
+    runner = aiohttp.web.AppRunner(cdn_app(args, counters))
+    await runner.setup()
+    cdn_port = free_port()
+    await aiohttp.web.TCPSite(runner, "127.0.0.1", cdn_port).start()
+    cdn = f"http://127.0.0.1:{cdn_port}"
+    # Avatars and emoji urls are built by discord.py itself
+    discord.Asset.BASE = cdn
+
+    config.s3 = config.S3Config(BUCKET, BUCKET, "benchmark", "benchmark", s3_endpoint)
+    config.mgmt = config.ManagementConfig([], 0, 0, 0, 0, "")
+    # Nothing is synced to an archive, but exports still read whether to write the legacy transcripts
+    config.archive = config.ArchiveConfig("http://127.0.0.1/", b"benchmark")
+    config.ratelimit = config.RateLimitConfig(bulk_rate=args.bulk_rate)
+    config.export = config.ExportConfig(
+            compression=args.compression,
+            # everything comes from the one local CDN
+            host_limits={"127.0.0.1": args.host_limit},
+            status_interval=1,
+            state_db=f"{workdir}/exports.sqlite",
+            inventory_path=f"{workdir}/assets.idx")
+
+    channels = make_channels(args, cdn, random.Random(args.seed))
+    http = FakeHTTP(channels, counters, args.latency)
+    state = discord.state.ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={},
+            syncer=None, http=http, loop=asyncio.get_event_loop())
+    category = types.SimpleNamespace(
+            id=snowflake(DISCORD_EPOCH + 1),
+            name="benchmark",
+            channels=[FakeChannel(state, channel_id) for channel_id in channels])
+    bot = types.SimpleNamespace(http=http, get_channel=lambda channel_id: None)
+    governor = ratelimit.Governor(config.ratelimit.bulk_rate, config.ratelimit.route_limits, config.ratelimit.default_route_limit)
+    mgr = TranscriptManager(bot, governor)
+    try:
+        await prepare_bucket(mgr)
+        for number in range(1, args.runs + 1):
+            counters.requests.clear()
+            counters.bytes.clear()
+            uploaded = mgr.uploaded_bytes
+            started = time.perf_counter()
+            await export(mgr, category, counters)
+            elapsed = time.perf_counter() - started
+            counters.bytes["s3 uploaded"] = mgr.uploaded_bytes - uploaded
+            report(number, elapsed, counters, args)
+    finally:
+        await mgr.session.close()
+        await runner.cleanup()
+
+def report(number: int, elapsed: float, counters: Counters, args):
+    messages = args.channels * args.messages
+    print(f"run {number}: {elapsed:.2f}s wall, {messages / elapsed:.0f} messages/s")
+    for endpoint, count in sorted(counters.requests.items()):
+        print(f"  {endpoint:>36}: {count:8d} requests")
+    for what, size in sorted(counters.bytes.items()):
+        print(f"  {what:>36}: {size / 2**20:8.1f} MiB")
+    # ru_maxrss is in KiB on linux
+    print(f"  {'peak RSS':>36}: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:8.1f} MiB")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=2000, help="messages per channel")
+    parser.add_argument("--users", type=int, default=50, help="distinct authors, so distinct avatars")
+    parser.add_argument("--attachments", type=float, default=0.1, help="fraction of messages with an attachment")
+    parser.add_argument("--embeds", type=float, default=0.05, help="fraction of messages with an embed thumbnail")
+    parser.add_argument("--attachment-size", type=int, default=256 * 1024)
+    parser.add_argument("--small-size", type=int, default=16 * 1024, help="size of avatars and thumbnails")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake discord request")
+    parser.add_argument("--host-limit", type=int, default=8, help="concurrent downloads from the CDN")
+    parser.add_argument("--bulk-rate", type=float, default=20)
+    parser.add_argument("--compression", choices=["gzip", "zstd"])
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--s3-endpoint", help="use this S3 endpoint instead of starting moto")
+    args = parser.parse_args()
+    with local_s3(args.s3_endpoint) as endpoint, tempfile.TemporaryDirectory() as workdir:
+        asyncio.run(run(args, endpoint, workdir))
+
+if __name__ == "__main__":
+    main()
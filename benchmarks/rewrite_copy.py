@@ -0,0 +1,88 @@
+"""Compare copy.deepcopy with transcript.copy_for_rewrite on synthetic messages.
+
+Run with `poetry run python benchmarks/rewrite_copy.py [messages]`.
+"""
+import copy
+import random
+import sys
+import time
+import tracemalloc
+
+from organizers_bot.transcript import copy_for_rewrite
+
+def user(idx: int) -> dict:
+    return {
+        "id": str(10**17 + idx),
+        "username": f"player{idx}",
+        "avatar": f"{idx:032x}",
+        "discriminator": f"{idx % 10000:04}",
+        "public_flags": 0,
+    }
+
+def message(idx: int, rng: random.Random) -> dict:
+    msg = {
+        "id": str(10**18 + idx),
+        "type": 0,
+        "channel_id": str(10**17),
+        "author": user(rng.randrange(20)),
+        "content": "".join(rng.choice("abcdefghij klmnop") for _ in range(rng.randrange(20, 200))),
+        "timestamp": "2021-06-01T12:00:00.000000+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [user(rng.randrange(20)) for _ in range(rng.randrange(3))],
+        "mention_roles": [],
+        "pinned": False,
+        "flags": 0,
+        "components": [],
+        "attachments": [],
+        "embeds": [],
+    }
+    if rng.random() < 0.2:
+        msg["attachments"] = [{
+            "id": str(10**18 + idx),
+            "filename": "screenshot.png",
+            "size": rng.randrange(10**6),
+            "url": f"https://cdn.discordapp.com/attachments/1/{idx}/screenshot.png",
+            "proxy_url": f"https://media.discordapp.net/attachments/1/{idx}/screenshot.png",
+            "width": 1920,
+            "height": 1080,
+            "content_type": "image/png",
+        }]
+    if rng.random() < 0.1:
+        msg["embeds"] = [{
+            "type": "link",
+            "url": f"https://example.com/{idx}",
+            "title": "Some writeup",
+            "description": "x" * 200,
+            "provider": {"name": "example"},
+            "thumbnail": {"url": f"https://example.com/{idx}.png", "proxy_url": f"https://images-ext-1.discordapp.net/{idx}.png", "width": 400, "height": 300},
+        }]
+    if rng.random() < 0.1:
+        msg["reactions"] = [{"count": 3, "me": False, "emoji": {"id": str(idx), "name": "pepega"}}]
+    if rng.random() < 0.02:
+        msg["sticker_items"] = [{"id": str(idx), "name": "sticker", "format_type": 1}]
+    return msg
+
+def measure(name: str, fn, messages: list) -> tuple[float, int]:
+    tracemalloc.start()
+    start = time.perf_counter()
+    copies = [fn(msg) for msg in messages]
+    elapsed = time.perf_counter() - start
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del copies
+    per_10k = 10_000 / len(messages)
+    print(f"{name:>16}: {elapsed * per_10k * 1000:8.1f} ms, {allocated * per_10k / 2**20:8.2f} MiB per 10k messages")
+    return elapsed, allocated
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    rng = random.Random(1337)
+    messages = [message(idx, rng) for idx in range(count)]
+    deep_time, deep_mem = measure("deepcopy", copy.deepcopy, messages)
+    rewrite_time, rewrite_mem = measure("copy_for_rewrite", copy_for_rewrite, messages)
+    print(f"{deep_time / rewrite_time:.1f}x faster, {deep_mem / rewrite_mem:.1f}x less memory retained")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 from . import config
 from . import transcript
 from . import ctfnote
+from . import ratelimit
+from . import jobs
+from . import journal
 
 import asyncio
+import fnmatch
 import functools
 import hashlib
 import logging
@@ -15,6 +19,9 @@ from discord_slash.model import SlashCommandOptionType
 
 
 
+# Paces all bulk REST work, set up in setup()
+governor: ratelimit.Governor
+
 def require_role(minreq=None):
     if minreq is None:
         minreq = config.mgmt.player_role
@@ -30,6 +37,7 @@ def require_role(minreq=None):
     return decorator
 
 def setup():
+    global governor
     assert config.is_loaded
 
     # the warning about using commands.Bot instead of discord.Client is explained here:
@@ -39,11 +47,72 @@ def setup():
     bot = discord.Client(intents=discord.Intents.default())
     slash = discord_slash.SlashCommand(bot, sync_commands=True)
     log = logging.getLogger("bot")
-    trans_mgr = transcript.TranscriptManager(bot)
+    governor = ratelimit.Governor(config.ratelimit.bulk_rate, config.ratelimit.route_limits, config.ratelimit.default_route_limit)
+    message_journal = None
+    if config.journal.enabled:
+        message_journal = journal.Journal(config.journal.path, config.journal.segment_bytes,
+                config.journal.retention, config.journal.margin)
+    trans_mgr = transcript.TranscriptManager(bot, governor, message_journal)
+    job_queue = jobs.JobQueue(config.jobs.workers)
+
+    def submit_export(category: discord.CategoryChannel, channel: discord.TextChannel) -> tuple[jobs.Job, bool]:
+        return job_queue.submit("export", f"category:{category.id}", category.name,
+                lambda job: trans_mgr.create(category, channel, job))
+
+    def journaled(channel) -> bool:
+        """Whether the messages of channel go in the journal: those of the ctf categories and their archives."""
+        if not isinstance(channel, discord.TextChannel) or channel.category is None:
+            return False
+        return channel.category.name in config.mgmt.categories or channel.category.name.startswith("Archive-")
+
+    if message_journal is not None:
+        @bot.event
+        async def on_connect():
+            message_journal.connected()
+
+        @bot.event
+        async def on_disconnect():
+            message_journal.disconnected()
+
+        @bot.event
+        async def on_socket_response(msg):
+            # The raw payloads, as those are what the REST API would give the export too
+            message_journal.heartbeat()
+            if msg.get("t") not in journal.EVENTS:
+                return
+            if journaled(bot.get_channel(int(msg["d"]["channel_id"]))):
+                message_journal.append(msg["t"], msg["d"])
+
+        @bot.event
+        async def on_guild_channel_create(channel):
+            if journaled(channel):
+                # Nothing can be older than the channel itself
+                message_journal.follow(channel.id, channel.id)
+
+        @bot.event
+        async def on_guild_channel_update(before, after):
+            if journaled(after) and not journaled(before):
+                message_journal.follow(after.id)
+            elif journaled(before) and not journaled(after):
+                message_journal.forget(after.id)
+
+    resumed_exports = False
 
     @bot.event
     async def on_ready():
+        nonlocal resumed_exports
         guild = bot.get_guild(config.bot.guild)
+        if message_journal is not None:
+            # Channels may have been moved around while we were gone
+            for channel_id in list(message_journal.channels):
+                if not journaled(bot.get_channel(channel_id)):
+                    message_journal.forget(channel_id)
+        # on_ready also fires after reconnecting, only resume once
+        if not resumed_exports:
+            resumed_exports = True
+            for category, channel in trans_mgr.interrupted_exports():
+                job, _ = submit_export(category, channel)
+                await channel.send(f"Resuming interrupted export of {category.name} as job #{job.id}")
 
         log.info(discord.utils.oauth_url(
             config.bot.client_id,
@@ -182,14 +251,27 @@ def setup():
     async def archive(ctx: discord_slash.SlashContext, name: str):
         if ctx.guild is None:
             return
-        await ctx.defer()
-        new_cat = await ctx.guild.create_category(f"Archive-{name}", position=999)
-        for cat in ctx.guild.categories:
-            if cat.name not in config.mgmt.categories:
-                continue
-            for chan in cat.text_channels:
-                await chan.edit(category=new_cat)
-        await ctx.send(f"Archived {name}")
+        guild = ctx.guild
+        channel = ctx.channel
+
+        async def run(job: jobs.Job):
+            new_cat = await guild.create_category(f"Archive-{name}", position=999)
+            channels = [chan for cat in guild.categories if cat.name in config.mgmt.categories for chan in cat.text_channels]
+            moved = 0
+            job.progress = lambda: f"{moved}/{len(channels)} channels moved"
+
+            async def move(chan: discord.TextChannel):
+                nonlocal moved
+                await governor.submit("channel_edit", guild.id, chan.edit, category=new_cat)
+                moved += 1
+            await asyncio.gather(*map(move, channels))
+            await channel.send(f"Archived {name}")
+
+        job, created = job_queue.submit("archive", f"archive:{guild.id}", name, run)
+        if created:
+            await ctx.send(f"Archiving {name} as job #{job.id}")
+        else:
+            await ctx.send(f"Job #{job.id} is already archiving {job.description}, try again when it's done")
 
     @slash.slash(name="export",
                  description="Move the specified category to a nice new upstate farm.",
@@ -198,22 +280,34 @@ def setup():
                      create_option(name="category",
                                    description="Which category to move.",
                                    option_type=SlashCommandOptionType.CHANNEL,
-                                   required=True)
+                                   required=True),
+                     create_option(name="dry_run",
+                                   description="Only estimate how long it would take and how much it would store.",
+                                   option_type=SlashCommandOptionType.BOOLEAN,
+                                   required=False)
                  ])
     @require_role(config.mgmt.player_role)
-    async def export(ctx: discord_slash.SlashContext, category: discord.abc.GuildChannel):
-        # hacky but idc
-        # lucid: It seems this can be fixed by updating discordpy and discord_slash.
-        if ctx.deferred or ctx.responded:
-            log.info("not sure why but handler called twice, ignoring")
-            return
+    async def export(ctx: discord_slash.SlashContext, category: discord.abc.GuildChannel, dry_run: bool = False):
         if not isinstance(category, discord.CategoryChannel):
             log.info("Tried exporting non category channel %s", category.name)
             await ctx.send("Can only export categories, not normal channels!")
             return
-        log.info("Exporting %s", category.name, exc_info=True)
-        await ctx.defer()
-        await trans_mgr.create(category, ctx)
+        if dry_run:
+            job, created = job_queue.submit("estimate", f"estimate:{category.id}", category.name,
+                    lambda job: trans_mgr.estimate(category, ctx.channel, job))
+            if created:
+                await ctx.send(f"Estimating the export of {category.name} as job #{job.id}")
+            else:
+                await ctx.send(f"Job #{job.id} is already estimating {category.name}")
+            return
+        log.info("Exporting %s", category.name)
+        # The export reports to the channel directly, as it can take longer
+        # than the interaction stays valid.
+        job, created = submit_export(category, ctx.channel)
+        if created:
+            await ctx.send(f"Exporting {category.name} as job #{job.id}")
+        else:
+            await ctx.send(f"{category.name} is already being handled by job #{job.id} ({job.kind}, {job.status})")
         # # TODO: Support specifying timezone?
         # if ctx.guild is None:
         #     return
@@ -231,6 +325,36 @@ def setup():
         # msg = await transcript_channel.send(f"Transcript for {ctx.channel.name}", file=transcript_file)
         # await ctx.send(f"Transcript created [here]({msg.jump_url})")
 
+    @slash.slash(name="export_many",
+                 description="Export several categories in one go, like after a busy weekend.",
+                 guild_ids=[config.bot.guild],
+                 options=[
+                     create_option(name="categories",
+                                   description="Comma separated category names, or a pattern like Archive-*",
+                                   option_type=SlashCommandOptionType.STRING,
+                                   required=True)
+                 ])
+    @require_role(config.mgmt.player_role)
+    async def export_many(ctx: discord_slash.SlashContext, categories: str):
+        if ctx.guild is None:
+            return
+        patterns = [pattern.strip() for pattern in categories.split(",") if pattern.strip()]
+        matched = [category for category in ctx.guild.categories
+                if any(fnmatch.fnmatchcase(category.name, pattern) for pattern in patterns)]
+        if not matched:
+            await ctx.send(f"No categories match {categories}")
+            return
+        names = ", ".join(category.name for category in matched)
+        log.info("Exporting %s", names)
+        # Also claims every single category, so they can't be exported or nuked meanwhile
+        job, created = job_queue.submit("export", "export_many:" + ",".join(str(category.id) for category in matched), names,
+                lambda job: trans_mgr.create_many(matched, ctx.channel, job),
+                extra_keys=[f"category:{category.id}" for category in matched])
+        if created:
+            await ctx.send(f"Exporting {names} as job #{job.id}")
+        else:
+            await ctx.send(f"Some of {names} are already being handled by job #{job.id} ({job.kind}, {job.status})")
+
     @slash.slash(name="nuke",
                  description="Remove all channels in a given category, destructive. Use /export first!",
                  guild_ids=[config.bot.guild],
@@ -253,11 +377,54 @@ def setup():
         if reference != confirm:
             await ctx.send(f"Are you ***REALLY*** sure you performed the /export for {category.name}?? If so, use this as confirmation code: {reference}", hidden=True)
             return
-        await ctx.defer()
-        for chan in category.channels:
-            await chan.delete(reason=f"Nuked by {ctx.author.name} with #{category.name}")
-        await category.delete(reason=f"Nuked by {ctx.author.name}")
-        await ctx.send(f"Category {category.name} was nuked on request of {ctx.author.name}", hidden=False)
+        author = ctx.author
+        channel = ctx.channel
+
+        async def run(job: jobs.Job):
+            channels = list(category.channels)
+            deleted = 0
+            job.progress = lambda: f"{deleted}/{len(channels)} channels deleted"
+
+            async def delete(chan: discord.abc.GuildChannel):
+                nonlocal deleted
+                await governor.submit("channel_delete", category.guild.id, chan.delete, reason=f"Nuked by {author.name} with #{category.name}")
+                deleted += 1
+            await asyncio.gather(*map(delete, channels))
+            await category.delete(reason=f"Nuked by {author.name}")
+            # The channel we were called from may have been nuked too
+            if channel not in channels:
+                await channel.send(f"Category {category.name} was nuked on request of {author.name}")
+
+        # Same key as exports, so we never nuke a category that is still being exported
+        job, created = job_queue.submit("nuke", f"category:{category.id}", category.name, run)
+        if created:
+            await ctx.send(f"Nuking {category.name} as job #{job.id}", hidden=False)
+        else:
+            await ctx.send(f"{category.name} is already being handled by job #{job.id} ({job.kind}, {job.status})", hidden=True)
+
+    @slash.slash(name="jobs",
+                 description="List the running and queued jobs, or cancel one",
+                 guild_ids=[config.bot.guild],
+                 options=[
+                     create_option(name="cancel",
+                                   description="Id of the job to cancel (admins only)",
+                                   option_type=SlashCommandOptionType.INTEGER,
+                                   required=False)
+                     ])
+    @require_role(config.mgmt.player_role)
+    async def list_jobs(ctx: discord_slash.SlashContext, cancel: typing.Optional[int] = None):
+        if cancel is None:
+            await ctx.send(job_queue.describe()[:2000])
+            return
+        if config.mgmt.admin_role not in [r.id for r in ctx.author.roles]:
+            await ctx.send("Only admins can cancel jobs", hidden=True)
+            return
+        job = job_queue.cancel(cancel)
+        if job is None:
+            await ctx.send(f"There is no job #{cancel} running or queued", hidden=True)
+        else:
+            log.info("%s cancelled job #%d", ctx.author.name, job.id)
+            await ctx.send(f"Cancelled job #{job.id} ({job.kind} {job.description})")
 
 
 
@@ -341,7 +508,7 @@ def setup():
             if isinstance(chan, discord.CategoryChannel):
                 num_cats += 1
         
-        await ctx.send(f"Channels: {num_channels}/500, {500 - num_channels} left\nCategories: {num_cats}")
+        await ctx.send(f"Channels: {num_channels}/500, {500 - num_channels} left\nCategories: {num_cats}\n{governor.describe()}")
 
     ## Keep this last :)
     return bot
@@ -2,6 +2,7 @@ import dataclasses
 import json
 import logging
 import pathlib
+import typing
 
 @dataclasses.dataclass
 class BotConfig:
@@ -24,14 +25,110 @@ class S3Config:
     bucket_name: str
     key: str
     keyID: str
+    endpoint_url: str = "https://s3.us-west-002.backblazeb2.com"
 
 @dataclasses.dataclass
 class ArchiveConfig:
     url: str
     secret: bytes
+    # objects per signed manifest request
+    manifest_chunk: int = 1000
+    sync_attempts: int = 5
+    # seconds before the first retry, doubling every attempt
+    sync_backoff: float = 2.0
+    # Also write the rewritten messages.json and assets.json of every channel, for an archive that
+    # doesn't read messages.orig.json with rewrites.json yet. Once off, exports delete them,
+    # which is where the storage and upload savings of rewrites.json come from.
+    legacy_transcripts: bool = True
+
+@dataclasses.dataclass
+class ExportConfig:
+    # Maximum number of asset transfers in flight across all exports
+    max_concurrency: int = 16
+    # Per-host limits, anything not listed here (external embed hosts) gets default_host_limit
+    host_limits: dict[str, int] = dataclasses.field(default_factory=lambda: {
+        "cdn.discordapp.com": 8,
+        "media.discordapp.net": 4,
+        })
+    default_host_limit: int = 2
+    # How many messages of a channel can have their assets in flight at once
+    message_window: int = 100
+    # How many 8MiB parts of a single upload may be in flight at once
+    upload_parts: int = 2
+    # Threads that hash and compress export data, so that doesn't hold up the bot
+    cpu_workers: int = 2
+    # Processes that serialize export json: json.dumps doesn't let go of the GIL, so a thread wouldn't do
+    json_processes: int = 2
+    # Assets larger than this (in bytes) are streamed to s3 instead of downloaded in one go
+    stream_threshold: int = 16 * 1024 * 1024
+    # Attachments up to this size (in bytes, as discord reports it) are copied while their channel is exported.
+    # Larger ones are copied in the background, so they don't hold up the transcript.
+    inline_attachment_bytes: int = 32 * 1024 * 1024
+    # Attachments larger than this aren't copied at all, the transcript only refers to them on discord
+    max_attachment_bytes: int = 1024 * 1024 * 1024
+    # How many of those background transfers may run at once
+    deferred_transfers: int = 2
+    # How often to try saving an asset (or transcript file) before giving up on it,
+    # waiting a random time up to asset_backoff * 2**attempt seconds in between
+    asset_attempts: int = 4
+    asset_backoff: float = 1.0
+    # How many assets of an export may fail (they keep their discord url, see failures.json) before its channels fail
+    asset_failure_budget: int = 100
+    # Content-Encoding for the transcript json: null, "gzip" or "zstd" (needs the zstd extra, `poetry install -E zstd`)
+    compression: typing.Optional[str] = None
+    # Minimum number of seconds between edits of the export status message
+    status_interval: float = 5
+    # Big channels are crawled in concurrent ranges of about this many messages
+    range_messages: int = 5000
+    # How many pages of 100 messages a range keeps in memory ahead of the export,
+    # the pages it fetches beyond that are spooled to a temporary file
+    range_prefetch_pages: int = 4
+    # Local sqlite database keeping track of exports, so they can be resumed
+    state_db: str = "exports.sqlite"
+    # How many saved assets to remember by their discord path
+    recent_assets: int = 10000
+    # Local index of the assets in the bucket, and how old (in seconds) it may get before listing the bucket again
+    inventory_path: str = "assets.idx"
+    inventory_max_age: float = 24 * 60 * 60
+    # Expected number of assets, and how many of them to keep exactly (20 bytes each) rather than in a bloom filter
+    inventory_capacity: int = 1_000_000
+    inventory_exact_limit: int = 200_000
+    # Number of shards of the search indexes, a query only loads the shards of its tokens
+    index_shards: int = 64
+
+@dataclasses.dataclass
+class RateLimitConfig:
+    # Requests per second bulk operations (exports, /archive, /nuke) may make,
+    # whatever is left of discord's global limit (50/s) is kept for interactive commands
+    bulk_rate: float = 20
+    # How many requests may be in flight at once per bucket of a route
+    route_limits: dict[str, int] = dataclasses.field(default_factory=lambda: {
+        "history": 4,
+        "channel_edit": 2,
+        "channel_delete": 2,
+        })
+    default_route_limit: int = 2
+
+@dataclasses.dataclass
+class JobsConfig:
+    # How many long running jobs (exports, archiving, nuking) can run at once
+    workers: int = 2
+
+@dataclasses.dataclass
+class JournalConfig:
+    # Journal the messages of the ctf categories (mgmt.categories and the archived ones),
+    # so exports only have to crawl what the journal missed
+    enabled: bool = False
+    # Directory with the journal segments
+    path: str = "journal"
+    segment_bytes: int = 64 * 1024 * 1024
+    # Segments older than this many seconds are deleted
+    retention: float = 60 * 24 * 60 * 60
+    # Seconds around (re)connects that are still crawled, for clock skew and connections dying unnoticed
+    margin: float = 120
 
 def load(filename: pathlib.Path):
-    global is_loaded, bot, mgmt, s3, archive
+    global is_loaded, bot, mgmt, s3, archive, export, ratelimit, jobs, journal
     with filename.open("r") as configfile:
         conf = json.load(configfile)
         bot = BotConfig(
@@ -51,12 +148,21 @@ def load(filename: pathlib.Path):
             conf['s3']['bucket'],
             conf['s3']['bucket_name'],
             conf['s3']['key'],
-            conf['s3']['keyID']
+            conf['s3']['keyID'],
+            conf['s3'].get('endpoint_url', S3Config.endpoint_url),
         )
         archive = ArchiveConfig(
             conf['archive']['url'],
             bytes.fromhex(conf['archive']['secret']),
+            conf['archive'].get('manifest_chunk', ArchiveConfig.manifest_chunk),
+            conf['archive'].get('sync_attempts', ArchiveConfig.sync_attempts),
+            conf['archive'].get('sync_backoff', ArchiveConfig.sync_backoff),
+            conf['archive'].get('legacy_transcripts', ArchiveConfig.legacy_transcripts),
         )
+        export = ExportConfig(**conf.get('export', {}))
+        ratelimit = RateLimitConfig(**conf.get('ratelimit', {}))
+        jobs = JobsConfig(**conf.get('jobs', {}))
+        journal = JournalConfig(**conf.get('journal', {}))
     is_loaded = True
 
 logging.basicConfig(level=logging.INFO)
@@ -65,3 +171,7 @@ bot: BotConfig
 mgmt: ManagementConfig
 s3: S3Config
 archive: ArchiveConfig
+export: ExportConfig
+ratelimit: RateLimitConfig
+jobs: JobsConfig
+journal: JournalConfig
@@ -0,0 +1,124 @@
+import logging
+import sqlite3
+import time
+import typing
+
+log = logging.getLogger("exportstate")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS exports (
+    id INTEGER PRIMARY KEY,
+    category_id INTEGER NOT NULL,
+    category_name TEXT NOT NULL,
+    status_channel_id INTEGER,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    assets INTEGER NOT NULL DEFAULT 0,
+    uploaded_bytes INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS channels (
+    export_id INTEGER NOT NULL REFERENCES exports(id),
+    channel_id INTEGER NOT NULL,
+    channel_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    last_message_id INTEGER,
+    message_count INTEGER,
+    error TEXT,
+    PRIMARY KEY (export_id, channel_id)
+);
+"""
+
+# export and channel states
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+PENDING = "pending"
+
+class ExportStore:
+    """Keeps track of exports on local disk, so they survive a restart of the bot.
+
+    For every export we remember the state of each of its channels, so an
+    interrupted export can be picked up again without redoing the channels
+    that already made it. A failed export isn't picked up again: the next one
+    starts over, and the state.json of each channel makes that cheap for the
+    channels that didn't change.
+    """
+    def __init__(self, path: str) -> None:
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        # Databases from before the export statistics
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(exports)")}
+        for column in ["messages", "assets", "uploaded_bytes"]:
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE exports ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+        self.db.commit()
+
+    def start(self, category_id: int, category_name: str, status_channel_id: typing.Optional[int]) -> int:
+        """Start a new export, or pick up the last one for this category if it was interrupted.
+        Returns the id of the export.
+        """
+        row = self.db.execute(
+                "SELECT id, status FROM exports WHERE category_id = ? ORDER BY id DESC LIMIT 1",
+                (category_id,)).fetchone()
+        if row is not None and row["status"] == RUNNING:
+            log.info("Resuming export %d of %s", row["id"], category_name)
+            self.db.execute(
+                    "UPDATE exports SET status = ?, status_channel_id = ?, category_name = ?, finished = NULL WHERE id = ?",
+                    (RUNNING, status_channel_id, category_name, row["id"]))
+            self.db.commit()
+            return row["id"]
+        cursor = self.db.execute(
+                "INSERT INTO exports (category_id, category_name, status_channel_id, status, started) VALUES (?, ?, ?, ?, ?)",
+                (category_id, category_name, status_channel_id, RUNNING, time.time()))
+        self.db.commit()
+        assert cursor.lastrowid is not None
+        return cursor.lastrowid
+
+    def finish(self, export_id: int, failed: bool, messages: int = 0, assets: int = 0, uploaded_bytes: int = 0):
+        """Mark an export as done or failed, with how much work it did."""
+        self.db.execute("""
+                UPDATE exports SET status = ?, finished = ?,
+                    messages = messages + ?, assets = assets + ?, uploaded_bytes = uploaded_bytes + ?
+                WHERE id = ?""",
+                (FAILED if failed else DONE, time.time(), messages, assets, uploaded_bytes, export_id))
+        self.db.commit()
+
+    def throughput(self, limit: int = 10) -> typing.Optional[tuple[float, float]]:
+        """(messages per second, assets per second) of the last exports that did some work, if any."""
+        row = self.db.execute("""
+                SELECT SUM(messages) AS messages, SUM(assets) AS assets, SUM(finished - started) AS duration
+                FROM (SELECT * FROM exports WHERE status = ? AND messages > 0 ORDER BY id DESC LIMIT ?)
+                """, (DONE, limit)).fetchone()
+        if row["duration"] is None or row["duration"] <= 0:
+            return None
+        return row["messages"] / row["duration"], row["assets"] / row["duration"]
+
+    def interrupted(self) -> list[sqlite3.Row]:
+        """Exports that were still running when the bot stopped."""
+        return self.db.execute("SELECT * FROM exports WHERE status = ?", (RUNNING,)).fetchall()
+
+    def done_channels(self, export_id: int) -> dict[int, typing.Optional[int]]:
+        """channel id -> last exported message id, of the channels the export already finished."""
+        rows = self.db.execute("SELECT channel_id, last_message_id FROM channels WHERE export_id = ? AND status = ?",
+                (export_id, DONE))
+        return {row["channel_id"]: row["last_message_id"] for row in rows}
+
+    def update_channel(self, export_id: int, channel_id: int, channel_name: str, status: str,
+            last_message_id: typing.Optional[int] = None, message_count: typing.Optional[int] = None,
+            error: typing.Optional[str] = None):
+        self.db.execute("""
+                INSERT INTO channels (export_id, channel_id, channel_name, status, last_message_id, message_count, error)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (export_id, channel_id) DO UPDATE SET
+                    channel_name = excluded.channel_name,
+                    status = excluded.status,
+                    last_message_id = COALESCE(excluded.last_message_id, last_message_id),
+                    message_count = COALESCE(excluded.message_count, message_count),
+                    error = excluded.error
+                """, (export_id, channel_id, channel_name, status, last_message_id, message_count, error))
+        self.db.commit()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+import typing
+
+log = logging.getLogger("inventory")
+
+class BloomFilter:
+    """Set membership in a fixed amount of memory, with false positives but no false negatives."""
+    def __init__(self, capacity: int, error_rate: float = 0.01, bits: typing.Optional[bytearray] = None) -> None:
+        self.capacity = capacity
+        self.error_rate = error_rate
+        size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.size = size - size % 8
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray(self.size // 8)
+
+    def positions(self, item: bytes) -> typing.Iterator[int]:
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: bytes):
+        for pos in self.positions(item):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, item: bytes) -> bool:
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self.positions(item))
+
+class AssetInventory:
+    """Which content addressed assets are already in the bucket.
+
+    Asset keys contain the sha1 of the asset, so only the 20 byte digests are
+    kept: exactly, up to exact_limit of them, and in a bloom filter beyond that.
+    contains() then answers without asking the bucket for anything we know
+    exactly, and for anything the bloom filter has never seen.
+
+    The inventory is built from a listing of the asset prefix, or loaded from
+    the index at path if that was saved less than max_age seconds ago.
+    """
+    def __init__(self, path: str, prefix: str, capacity: int, exact_limit: int, max_age: float) -> None:
+        self.path = path
+        self.prefix = prefix
+        self.capacity = capacity
+        self.exact_limit = exact_limit
+        self.max_age = max_age
+        self.built = 0.0
+        self.count = 0
+        self.exact: set[bytes] = set()
+        self.bloom = BloomFilter(capacity)
+
+    def digest(self, key: str) -> typing.Optional[bytes]:
+        """The sha1 in an asset key, as bytes."""
+        if not key.startswith(self.prefix):
+            return None
+        name = os.path.basename(key)
+        try:
+            return bytes.fromhex(name.split(".", 1)[0])
+        except ValueError:
+            return None
+
+    def reset(self, capacity: int):
+        self.capacity = capacity
+        self.count = 0
+        self.exact = set()
+        self.bloom = BloomFilter(capacity)
+
+    def add(self, key: str):
+        digest = self.digest(key)
+        if digest is None or digest in self.exact:
+            return
+        if digest not in self.bloom:
+            self.count += 1
+            self.bloom.add(digest)
+        if len(self.exact) < self.exact_limit:
+            self.exact.add(digest)
+
+    def contains(self, key: str) -> typing.Optional[bool]:
+        """True if the asset is in the bucket, False if it isn't, None if we'd have to check."""
+        digest = self.digest(key)
+        if digest is None:
+            return None
+        if digest in self.exact:
+            return True
+        if digest not in self.bloom:
+            return False
+        return None
+
+    async def refresh(self, s3, bucket: str):
+        """Make sure the inventory is recent, loading it from disk or listing the bucket."""
+        if time.time() - self.built < self.max_age:
+            return
+        if self.load():
+            return
+        started = time.monotonic()
+        keys: list[str] = []
+        paginator = s3.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=bucket, Prefix=self.prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        # Leave room to grow, so the bloom filter stays accurate
+        self.reset(max(self.capacity, 2 * len(keys)))
+        for key in keys:
+            self.add(key)
+        self.built = time.time()
+        log.info("Listed %d assets in %.1fs", len(keys), time.monotonic() - started)
+        self.save()
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                header = json.loads(f.readline())
+                if time.time() - header["built"] >= self.max_age:
+                    return False
+                bits = bytearray(f.read(header["bloom_bytes"]))
+                exact = f.read()
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, KeyError):
+            log.exception("Ignoring broken asset index %s", self.path)
+            return False
+        self.capacity = header["capacity"]
+        self.count = header["count"]
+        self.built = header["built"]
+        self.bloom = BloomFilter(self.capacity, bits=bits)
+        self.exact = {exact[i:i + 20] for i in range(0, len(exact), 20)}
+        log.info("Loaded asset index with %d assets", self.count)
+        return True
+
+    def save(self):
+        """Write the index to disk, so the next start doesn't have to list the bucket."""
+        header = {
+            "built": self.built,
+            "capacity": self.capacity,
+            "count": self.count,
+            "bloom_bytes": len(self.bloom.bits),
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header).encode() + b"\n")
+            f.write(self.bloom.bits)
+            f.write(b"".join(sorted(self.exact)))
+        os.replace(tmp, self.path)
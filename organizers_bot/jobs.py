@@ -0,0 +1,128 @@
+import asyncio
+import collections
+import dataclasses
+import itertools
+import logging
+import time
+import typing
+
+log = logging.getLogger("jobs")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+@dataclasses.dataclass
+class Job:
+    id: int
+    kind: str
+    # Jobs with the same key are never queued or running at the same time
+    key: str
+    description: str
+    run: typing.Callable[["Job"], typing.Awaitable[typing.Any]]
+    status: str = QUEUED
+    submitted: float = dataclasses.field(default_factory=time.monotonic)
+    # Set by the job while it runs, to say how far along it is
+    progress: typing.Optional[typing.Callable[[], str]] = None
+    task: typing.Optional[asyncio.Task] = None
+    # More keys, for jobs that cover several things (like exporting several categories)
+    extra_keys: tuple[str, ...] = ()
+
+    def keys(self) -> tuple[str, ...]:
+        return (self.key,) + self.extra_keys
+
+    def describe(self) -> str:
+        line = f"#{self.id} {self.kind} {self.description}: {self.status}"
+        if self.status == RUNNING and self.progress is not None:
+            try:
+                line += f", {self.progress()}"
+            except Exception:
+                log.exception("Failed to get progress of job %d", self.id)
+        return line
+
+class JobQueue:
+    """Runs long operations (exports, archiving, nuking) in the background,
+    with a fixed number of workers, so slash commands can reply right away.
+    """
+    def __init__(self, workers: int) -> None:
+        self.worker_count = workers
+        self.workers: list[asyncio.Task] = []
+        self.queue: asyncio.Queue[Job] = asyncio.Queue()
+        self.ids = itertools.count(1)
+        # key -> job, for jobs that are queued or running
+        self.active: dict[str, Job] = {}
+        self.finished: collections.deque[Job] = collections.deque(maxlen=10)
+
+    def submit(self, kind: str, key: str, description: str,
+            run: typing.Callable[[Job], typing.Awaitable[typing.Any]],
+            extra_keys: typing.Iterable[str] = ()) -> tuple[Job, bool]:
+        """Queue a job, unless a job with the same key (or any of extra_keys) is already queued or running.
+
+        Returns
+        -------
+        tuple[Job, bool]
+            The job that will take care of it, and whether it was newly created.
+        """
+        extra_keys = tuple(extra_keys)
+        for existing in (key,) + extra_keys:
+            if existing in self.active:
+                return self.active[existing], False
+        if not self.workers:
+            self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.worker_count)]
+        job = Job(next(self.ids), kind, key, description, run, extra_keys=extra_keys)
+        for job_key in job.keys():
+            self.active[job_key] = job
+        self.queue.put_nowait(job)
+        log.info("Queued job #%d: %s %s", job.id, kind, description)
+        return job, True
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            if job.status != QUEUED:
+                # cancelled while it was waiting
+                continue
+            job.status = RUNNING
+            job.task = asyncio.ensure_future(job.run(job))
+            try:
+                await job.task
+                job.status = DONE
+            except asyncio.CancelledError:
+                job.status = CANCELLED
+            except Exception:
+                log.exception("Job #%d (%s %s) failed", job.id, job.kind, job.description)
+                job.status = FAILED
+            finally:
+                self.release(job)
+                self.finished.append(job)
+
+    def release(self, job: Job):
+        for key in job.keys():
+            if self.active.get(key) is job:
+                del self.active[key]
+
+    def cancel(self, job_id: int) -> typing.Optional[Job]:
+        """Cancel a queued or running job, returns it if there was one with that id."""
+        for job in self.active.values():
+            if job.id != job_id:
+                continue
+            if job.status == QUEUED:
+                job.status = CANCELLED
+                self.release(job)
+                self.finished.append(job)
+            elif job.task is not None:
+                job.task.cancel()
+            return job
+        return None
+
+    def describe(self) -> str:
+        jobs = {job.id: job for job in self.active.values()}
+        lines = [jobs[job_id].describe() for job_id in sorted(jobs)]
+        if not lines:
+            lines.append("No jobs running or queued")
+        if self.finished:
+            lines.append("Recently finished:")
+            lines.extend(job.describe() for job in self.finished)
+        return "\n".join(lines)
@@ -0,0 +1,354 @@
+import array
+import json
+import logging
+import os
+import time
+import typing
+
+log = logging.getLogger("journal")
+
+DISCORD_EPOCH = 1420070400000
+
+MESSAGE_EVENTS = {"MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE", "MESSAGE_DELETE_BULK"}
+REACTION_EVENTS = {"MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE", "MESSAGE_REACTION_REMOVE_ALL", "MESSAGE_REACTION_REMOVE_EMOJI"}
+EVENTS = MESSAGE_EVENTS | REACTION_EVENTS
+
+# Only the gateway sends these, the REST API doesn't have them in its messages
+GATEWAY_ONLY = {"guild_id", "member"}
+
+def snowflake(seconds: float) -> int:
+    """The smallest snowflake of the given unix time."""
+    return max(0, int(seconds * 1000) - DISCORD_EPOCH) << 22
+
+def same_emoji(a: dict, b: dict) -> bool:
+    if a.get("id") or b.get("id"):
+        return a.get("id") == b.get("id")
+    return a.get("name") == b.get("name")
+
+def apply(messages: dict[int, dict], event: str, data: dict):
+    """Apply a journaled gateway event to messages, id -> message json."""
+    if event == "MESSAGE_CREATE":
+        messages[int(data["id"])] = data
+    elif event == "MESSAGE_UPDATE":
+        # Updates can be partial, and messages from before the journal are crawled anyway
+        if int(data["id"]) in messages:
+            messages[int(data["id"])].update(data)
+    elif event == "MESSAGE_DELETE":
+        messages.pop(int(data["id"]), None)
+    elif event == "MESSAGE_DELETE_BULK":
+        for message_id in data["ids"]:
+            messages.pop(int(message_id), None)
+    elif event in REACTION_EVENTS and int(data["message_id"]) in messages:
+        message = messages[int(data["message_id"])]
+        reactions = message.setdefault("reactions", [])
+        if event == "MESSAGE_REACTION_REMOVE_ALL":
+            reactions.clear()
+        elif event == "MESSAGE_REACTION_REMOVE_EMOJI":
+            reactions[:] = [reaction for reaction in reactions if not same_emoji(reaction["emoji"], data["emoji"])]
+        else:
+            reaction = next((reaction for reaction in reactions if same_emoji(reaction["emoji"], data["emoji"])), None)
+            if event == "MESSAGE_REACTION_ADD":
+                if reaction is None:
+                    reactions.append({"count": 1, "me": False, "emoji": data["emoji"]})
+                else:
+                    reaction["count"] += 1
+            elif reaction is not None:
+                reaction["count"] -= 1
+                if reaction["count"] <= 0:
+                    reactions.remove(reaction)
+        if not reactions:
+            del message["reactions"]
+
+def touched(event: str, data: dict) -> list[int]:
+    """The ids of the messages an event is about."""
+    if event == "MESSAGE_DELETE_BULK":
+        return [int(message_id) for message_id in data["ids"]]
+    if event in REACTION_EVENTS:
+        return [int(data["message_id"])]
+    return [int(data["id"])]
+
+def entries(events: list[tuple[str, list[int]]]) -> typing.Iterator[tuple[int, int, dict]]:
+    """Yields (segment number, offset, entry) for the given (segment path, offsets), skipping torn writes."""
+    for number, (path, offsets) in enumerate(events):
+        if not offsets:
+            continue
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # pruned in the meantime
+            continue
+        with f:
+            for offset in offsets:
+                f.seek(offset)
+                try:
+                    entry = json.loads(f.readline())
+                except ValueError:
+                    # a torn write at the end of a segment, after a crash
+                    continue
+                yield number, offset, entry
+
+def locate(events: list[tuple[str, list[int]]], lo: int, hi: int) -> dict[int, list[tuple[int, int]]]:
+    """Where the events of the messages with lo < id <= hi that still exist at the end of the journal are,
+    as message id -> (segment number, offset) of its create and everything after it.
+    Only these positions are kept, not the messages themselves, so this stays small for big channels.
+    """
+    located: dict[int, list[tuple[int, int]]] = {}
+    for number, offset, entry in entries(events):
+        for message_id in touched(entry["t"], entry["d"]):
+            if not lo < message_id <= hi:
+                continue
+            if entry["t"] == "MESSAGE_CREATE":
+                located[message_id] = [(number, offset)]
+            elif entry["t"] in ("MESSAGE_DELETE", "MESSAGE_DELETE_BULK"):
+                located.pop(message_id, None)
+            elif message_id in located:
+                located[message_id].append((number, offset))
+    return located
+
+def replay(events: list[tuple[str, list[int]]], positions: list[list[tuple[int, int]]]) -> list[dict]:
+    """The messages at the given positions from locate(), replayed from just their own events, sorted by id."""
+    wanted: dict[int, list[int]] = {}
+    for message_positions in positions:
+        for number, offset in message_positions:
+            wanted.setdefault(number, []).append(offset)
+    messages: dict[int, dict] = {}
+    for _, _, entry in entries([(path, sorted(wanted.get(number, []))) for number, (path, _) in enumerate(events)]):
+        apply(messages, entry["t"], entry["d"])
+    return [messages[message_id] for message_id in sorted(messages)]
+
+class Journal:
+    """An append-only log of the message events the gateway sends us,
+    so exports can take messages from here instead of crawling the history.
+
+    Events are appended to segment files in path, a new one is started once
+    the current one reaches segment_bytes, and segments older than retention
+    seconds are deleted.
+
+    The journal only knows it has every message of a channel for the time
+    the bot was connected (minus margin seconds on both ends, for clock skew
+    and a connection dying unnoticed), and since it started following that
+    channel. covered() tells which snowflakes that is, exports crawl the rest.
+
+    To replay a single channel without reading every event of the journal,
+    the byte offsets of each channel's events are indexed per segment: while
+    appending for the current segment, and on first use for the segments
+    from before the bot started (see events()).
+
+    Everything but events() runs on the event loop, events() only gets a
+    snapshot() of the segments so it can run in a worker thread.
+    """
+    def __init__(self, path: str, segment_bytes: int, retention: float, margin: float) -> None:
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.retention = retention
+        self.margin = margin
+        os.makedirs(path, exist_ok=True)
+        self.state_path = os.path.join(path, "journal.json")
+        # segment name -> {"created": unix time, "channels": set of channel ids}
+        self.segments: dict[str, dict] = {}
+        # [first, last] snowflakes during which we were connected, last is None while we are
+        self.intervals: list[list] = []
+        # channel id -> snowflake from which on we have all its messages
+        self.channels: dict[int, int] = {}
+        # when we last knew we were connected
+        self.mark = 0.0
+        self.saved = 0.0
+        self.live = False
+        self.current = ""
+        # Segments started in the same millisecond still get their own file
+        self.sequence = 0
+        self.file: typing.Optional[typing.BinaryIO] = None
+        # segment name -> channel id -> byte offsets of the channel's events
+        self.index: dict[str, dict[int, array.array]] = {}
+        self.load()
+        self.open_segment()
+
+    def load(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            log.exception("Ignoring broken journal state %s, starting over", self.state_path)
+            return
+        self.segments = {name: {"created": segment["created"], "channels": set(segment["channels"])}
+                for name, segment in state["segments"].items()
+                if os.path.exists(os.path.join(self.path, name))}
+        self.channels = {int(channel_id): since for channel_id, since in state["channels"].items()}
+        self.mark = state["mark"]
+        for first, last in state["intervals"]:
+            if last is None:
+                # We went down without noticing, all we know is when we were last connected
+                last = snowflake(self.mark - self.margin)
+            if first < last:
+                self.intervals.append([first, last])
+        log.info("Loaded journal with %d segments", len(self.segments))
+
+    def save(self):
+        if self.file is not None:
+            self.file.flush()
+        state = {
+            "segments": {name: {"created": segment["created"], "channels": sorted(segment["channels"])}
+                for name, segment in self.segments.items()},
+            "intervals": self.intervals,
+            "channels": {str(channel_id): since for channel_id, since in self.channels.items()},
+            "mark": self.mark,
+        }
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.state_path)
+        self.saved = time.time()
+
+    def open_segment(self):
+        now = time.time()
+        self.sequence += 1
+        self.current = f"{int(now * 1000):016d}-{self.sequence:06d}.log"
+        self.segments[self.current] = {"created": now, "channels": set()}
+        self.index[self.current] = {}
+        self.file = open(os.path.join(self.path, self.current), "ab")
+
+    def rotate(self):
+        assert self.file is not None
+        self.file.close()
+        self.file = None
+        self.prune()
+        self.open_segment()
+        self.save()
+
+    def prune(self):
+        cutoff = time.time() - self.retention
+        for name in sorted(self.segments):
+            path = os.path.join(self.path, name)
+            if name == self.current or os.path.getmtime(path) >= cutoff:
+                break
+            log.info("Deleting old journal segment %s", name)
+            os.remove(path)
+            del self.segments[name]
+            self.index.pop(name, None)
+        # Whatever happened before the oldest segment we still have is gone
+        if self.segments:
+            oldest = snowflake(min(segment["created"] for segment in self.segments.values()) + self.margin)
+            for interval in self.intervals:
+                interval[0] = max(interval[0], oldest)
+            self.intervals = [interval for interval in self.intervals if interval[1] is None or interval[0] < interval[1]]
+
+    def connected(self):
+        """The gateway (re)connected, from now on we get all events."""
+        if self.live:
+            return
+        self.live = True
+        self.mark = time.time()
+        self.intervals.append([snowflake(self.mark + self.margin), None])
+        self.save()
+
+    def disconnected(self):
+        """The gateway connection dropped, we may miss events until it's back."""
+        if not self.live:
+            return
+        self.live = False
+        self.intervals[-1][1] = snowflake(time.time() - self.margin)
+        if self.intervals[-1][0] >= self.intervals[-1][1]:
+            self.intervals.pop()
+        self.save()
+
+    def heartbeat(self):
+        """Note that the connection is still alive."""
+        self.mark = time.time()
+        if self.mark - self.saved > 60:
+            self.save()
+
+    def follow(self, channel_id: int, since: typing.Optional[int] = None):
+        """Start following a channel, we have all its messages after since (default: now)."""
+        self.channels[channel_id] = since if since is not None else snowflake(time.time())
+
+    def forget(self, channel_id: int):
+        """Stop following a channel, events for it are no longer journaled."""
+        self.channels.pop(channel_id, None)
+
+    def append(self, event: str, data: dict):
+        """Journal a gateway event of a followed channel."""
+        assert self.file is not None
+        channel_id = int(data["channel_id"])
+        data = {key: value for key, value in data.items() if key not in GATEWAY_ONLY}
+        offset = self.file.tell()
+        self.file.write(json.dumps({"t": event, "d": data}, separators=(",", ":")).encode() + b"\n")
+        self.segments[self.current]["channels"].add(channel_id)
+        self.index[self.current].setdefault(channel_id, array.array("Q")).append(offset)
+        if channel_id not in self.channels:
+            # We don't know what happened before, so only trust the journal from here on
+            self.follow(channel_id, int(data["id"]) - 1 if event == "MESSAGE_CREATE" else None)
+        if self.file.tell() >= self.segment_bytes:
+            self.rotate()
+        else:
+            self.heartbeat()
+
+    def covered(self, channel_id: int, after: int, until: int) -> list[tuple[int, int]]:
+        """The ranges of snowflakes (lo, hi] between after and until for which we have all messages of a channel."""
+        since = self.channels.get(channel_id)
+        if since is None:
+            return []
+        ranges = []
+        for first, last in self.intervals:
+            if last is None:
+                last = snowflake(time.time() - self.margin)
+            lo = max(first, since, after)
+            hi = min(last, until)
+            if lo < hi:
+                ranges.append((lo, hi))
+        return ranges
+
+    def snapshot(self, channel_id: int) -> list[tuple[str, typing.Optional[array.array]]]:
+        """The segments with events of a channel, oldest first, for events().
+        Each comes with a copy of the channel's offsets in it, or None if the segment isn't indexed yet.
+        """
+        if self.file is not None:
+            self.file.flush()
+        snapshot = []
+        for name, segment in sorted(self.segments.items()):
+            if channel_id not in segment["channels"]:
+                continue
+            index = self.index.get(name)
+            snapshot.append((name, None if index is None else index.get(channel_id, array.array("Q"))[:]))
+        return snapshot
+
+    def scan(self, name: str) -> dict[int, array.array]:
+        """Index a segment that was written before the bot started."""
+        index: dict[int, array.array] = {}
+        offset = 0
+        try:
+            with open(os.path.join(self.path, name), "rb") as f:
+                for line in f:
+                    try:
+                        channel_id = int(json.loads(line)["d"]["channel_id"])
+                    except ValueError:
+                        pass
+                    else:
+                        index.setdefault(channel_id, array.array("Q")).append(offset)
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        return index
+
+    def events(self, channel_id: int, snapshot: list[tuple[str, typing.Optional[array.array]]]
+            ) -> tuple[list[tuple[str, list[int]]], dict[str, dict[int, array.array]]]:
+        """(segment path, byte offsets) of the events of a channel in a snapshot(), for locate() and replay(),
+        and the indexes of the segments that had to be scanned for it, for add_index().
+        Run this in a worker thread, as it reads the segments that aren't indexed yet.
+        """
+        events = []
+        scanned = {}
+        for name, offsets in snapshot:
+            if offsets is None:
+                scanned[name] = self.scan(name)
+                offsets = scanned[name].get(channel_id)
+            if offsets:
+                events.append((os.path.join(self.path, name), offsets.tolist()))
+        return events, scanned
+
+    def add_index(self, scanned: dict[str, dict[int, array.array]]):
+        """Keep the indexes events() scanned, for the segments that weren't pruned since."""
+        for name, index in scanned.items():
+            if name in self.segments:
+                self.index.setdefault(name, index)
@@ -0,0 +1,86 @@
+import asyncio
+import collections
+import logging
+import time
+import typing
+
+log = logging.getLogger("ratelimit")
+
+T = typing.TypeVar("T")
+
+class Governor:
+    """Schedules bulk discord REST work (exports, archiving, nuking).
+
+    discord.py only reacts to 429s after the fact, and its global rate limit
+    is shared by everything the bot does. So bulk work is paced to at most
+    bulk_rate requests per second. Interactive slash command replies don't
+    go through here at all: their fast lane is simply the headroom between
+    bulk_rate and discord's global limit, so keep bulk_rate well below that.
+    On top of that, each bucket (a route together with its major parameter,
+    like discord does it) gets a limited number of concurrent requests.
+    """
+    def __init__(self, bulk_rate: float, route_limits: dict[str, int], default_route_limit: int) -> None:
+        self.interval = 1 / bulk_rate
+        self.next_slot = 0.0
+        self.route_limits = route_limits
+        self.default_route_limit = default_route_limit
+        self.buckets: dict[tuple[str, typing.Any], asyncio.Semaphore] = {}
+        self.queued: collections.Counter[str] = collections.Counter()
+        self.running: collections.Counter[str] = collections.Counter()
+
+    def limit(self, route: str) -> int:
+        """How many requests may run at once in a single bucket of route."""
+        return self.route_limits.get(route, self.default_route_limit)
+
+    def bucket(self, route: str, major) -> asyncio.Semaphore:
+        key = (route, major)
+        if key not in self.buckets:
+            self.buckets[key] = asyncio.Semaphore(self.limit(route))
+        return self.buckets[key]
+
+    async def pace(self):
+        """Wait for the next bulk request slot."""
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def submit(self, route: str, major, fn: typing.Callable[..., typing.Awaitable[T]], *args, **kwargs) -> T:
+        """Run a bulk request fn(*args, **kwargs) on the given route, once there is room for it.
+
+        Parameters
+        ----------
+        route : str
+            Name of the kind of request, e.g. "channel_edit".
+        major : Any
+            The major parameter of the route (guild or channel id), requests
+            with different major parameters don't share a bucket.
+        """
+        self.queued[route] += 1
+        started = False
+        try:
+            async with self.bucket(route, major):
+                await self.pace()
+                self.queued[route] -= 1
+                self.running[route] += 1
+                started = True
+                return await fn(*args, **kwargs)
+        finally:
+            if started:
+                self.running[route] -= 1
+            else:
+                self.queued[route] -= 1
+
+    def depths(self) -> dict[str, tuple[int, int]]:
+        """route -> (queued, running) for every route that has work."""
+        routes = set(self.queued) | set(self.running)
+        return {route: (self.queued[route], self.running[route])
+                for route in sorted(routes)
+                if self.queued[route] or self.running[route]}
+
+    def describe(self) -> str:
+        depths = self.depths()
+        if not depths:
+            return "No bulk requests queued"
+        return "\n".join(f"{route}: {queued} queued, {running} running" for route, (queued, running) in depths.items())
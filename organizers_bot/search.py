@@ -0,0 +1,115 @@
+import datetime
+import re
+import typing
+import zlib
+
+DISCORD_EPOCH = 1420070400000
+
+TOKEN = re.compile(r"\w{2,40}")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "if", "in", "is", "it",
+    "of", "on", "or", "so", "that", "the", "this", "to", "was", "we", "with", "you",
+}
+
+def tokenize(text: str) -> set[str]:
+    """The distinct search tokens in text. The archive has to tokenize queries the same way."""
+    return {token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS}
+
+def shard_of(token: str, shards: int) -> int:
+    """Which shard of an index a token lives in."""
+    return zlib.crc32(token.encode("utf8")) % shards
+
+def day_of(message_id: int) -> str:
+    """The (UTC) day a message was sent on, from its snowflake."""
+    ms = (message_id >> 22) + DISCORD_EPOCH
+    return datetime.datetime.fromtimestamp(ms / 1000, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+def message_text(data: dict) -> str:
+    """Everything searchable in a message json."""
+    parts = [data.get("content") or ""]
+    parts.extend(attachment.get("filename", "") for attachment in data.get("attachments", []))
+    for embed in data.get("embeds", []):
+        parts.append(embed.get("title", ""))
+        parts.append(embed.get("description", ""))
+    return "\n".join(parts)
+
+class ChannelIndex:
+    """Search index of a single channel, built while its messages are exported.
+
+    It is stored next to the channel's transcript, so an incremental export
+    can continue it, and the category index can be rebuilt from the channel
+    indexes without looking at any messages.
+    """
+    def __init__(self, data: typing.Optional[dict] = None) -> None:
+        data = data or {}
+        # token -> message ids
+        self.tokens: dict[str, list[int]] = data.get("tokens", {})
+        # author id -> {"name": str, "messages": [message ids]}
+        self.authors: dict[str, dict] = data.get("authors", {})
+        # day -> [first message id, last message id, message count]
+        self.days: dict[str, list[int]] = data.get("days", {})
+
+    def add(self, data: dict):
+        message_id = int(data["id"])
+        for token in tokenize(message_text(data)):
+            self.tokens.setdefault(token, []).append(message_id)
+        author = data.get("author")
+        if author is not None:
+            entry = self.authors.setdefault(author["id"], {"name": author.get("username", ""), "messages": []})
+            entry["name"] = author.get("username", entry["name"])
+            entry["messages"].append(message_id)
+        day = self.days.setdefault(day_of(message_id), [message_id, message_id, 0])
+        day[0] = min(day[0], message_id)
+        day[1] = max(day[1], message_id)
+        day[2] += 1
+
+    def to_json(self) -> dict:
+        # Sorted, so an unchanged index is stored as the exact same object
+        return {"tokens": dict(sorted(self.tokens.items())), "authors": self.authors, "days": self.days}
+
+class CategoryIndex:
+    """The search index of a whole category, merged from its channel indexes.
+
+    Tokens are split over shards by shard_of(), so a query only needs the
+    shards of its own tokens: tokens/<shard>.json maps token -> channel -> message ids.
+    authors.json maps author id -> name and channel -> message ids,
+    dates.json maps day -> channel -> [first message id, last message id, count].
+    """
+    def __init__(self, shards: int) -> None:
+        self.shards = shards
+        self.tokens: list[dict[str, dict[str, list[int]]]] = [{} for _ in range(shards)]
+        self.authors: dict[str, dict] = {}
+        self.dates: dict[str, dict[str, list[int]]] = {}
+        self.channels: list[str] = []
+        self.messages = 0
+
+    def add(self, channel: str, index: ChannelIndex):
+        self.channels.append(channel)
+        for token, ids in sorted(index.tokens.items()):
+            self.tokens[shard_of(token, self.shards)].setdefault(token, {})[channel] = ids
+        for author_id, entry in index.authors.items():
+            author = self.authors.setdefault(author_id, {"name": entry["name"], "messages": {}})
+            author["messages"][channel] = entry["messages"]
+        for day, span in index.days.items():
+            self.dates.setdefault(day, {})[channel] = span
+            self.messages += span[2]
+
+    def token_counts(self) -> dict[str, int]:
+        """token -> number of messages it is in, for the global index."""
+        return {token: sum(map(len, channels.values())) for shard in self.tokens for token, channels in shard.items()}
+
+    def meta(self) -> dict:
+        return {"shards": self.shards, "channels": sorted(self.channels), "messages": self.messages}
+
+def merge_global(shard: dict[str, dict[str, int]], category: str, counts: dict[str, int]) -> dict[str, dict[str, int]]:
+    """Replace what a global index shard (token -> category -> count) knows about category with counts.
+    counts should only hold the tokens that belong in this shard.
+    """
+    merged = {}
+    for token, categories in shard.items():
+        categories = {name: count for name, count in categories.items() if name != category}
+        if categories:
+            merged[token] = categories
+    for token, count in counts.items():
+        merged.setdefault(token, {})[category] = count
+    return dict(sorted(merged.items()))
@@ -1,339 +1,1999 @@
 from . import config
+from . import exportstate
+from . import inventory
+from . import jobs
+from . import journal
+from . import ratelimit
+from . import search
 import logging
 import discord
-import discord.iterators
 import discord.http
 import discord_slash
 import asyncio
 import aiohttp
+import collections
+import concurrent.futures
+import contextlib
+import datetime
 import os
+import random
+import tempfile
+import time
 from urllib import parse
 import hashlib
-import copy
+import itertools
 import json
+import multiprocessing
+import pickle
 import aiobotocore
 import aiobotocore.client
+import aiobotocore.config
+import botocore.exceptions
 import hmac
+import typing
 import urllib
+import uuid
+import zlib
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
 
 log = logging.getLogger("transcript")
 
-class JSONHistoryIterator(discord.iterators.HistoryIterator):
-    async def flatten(self):
-        # this is similar to fill_messages except it uses a list instead
-        # of a queue to place the messages in.
-        result = []
-        channel = await self.messageable._get_channel()
-        self.channel = channel
-        while self._get_retrieve():
-            data = await self._retrieve_messages(self.retrieve)
-            if len(data) < 100:
-                self.limit = 0 # terminate the infinite loop
-
-            if self.reverse:
-                data = reversed(data)
-            if self._filter:
-                data = filter(self._filter, data)
-
-            for element in data:
-                result.append((self.state.create_message(channel=channel, data=element), element))
-        return result
-
-    async def fill_messages(self):
-        if not hasattr(self, 'channel'):
-            # do the required set up
-            channel = await self.messageable._get_channel()
-            self.channel = channel
-
-        if self._get_retrieve():
-            data = await self._retrieve_messages(self.retrieve)
-            if len(data) < 100:
-                self.limit = 0 # terminate the infinite loop
-
-            if self.reverse:
-                data = reversed(data)
-            if self._filter:
-                data = filter(self._filter, data)
-
-            channel = self.channel
-            for element in data:
-                await self.messages.put((self.state.create_message(channel=channel, data=element), element))
-
-def json_history(mable: discord.abc.Messageable, limit=10000, before=None, after=None, around=None, oldest_first=None):
-    return JSONHistoryIterator(mable, limit=limit, before=before, after=after, around=around, oldest_first=oldest_first)
+T = typing.TypeVar("T")
+
+# Where content addressed assets are stored
+ASSET_PREFIX = "assets/sha1"
+# The search index across all categories
+SEARCH_INDEX = "archive/index"
+# Big json is encoded in pieces of about this many elements, see json_pieces
+JSON_PIECE = 5000
+# What a channel's transcript looks like, kept in its state.json.
+# 2: messages.orig.json with rewrites.json, instead of messages.json and assets.json next to it
+TRANSCRIPT_FORMAT = 2
+
+def compressor(encoding: typing.Optional[str]):
+    """A compressobj for the given Content-Encoding, or None for no compression."""
+    if encoding is None:
+        return None
+    if encoding == "gzip":
+        # zlib leaves the gzip header timestamp at 0, so the output is reproducible
+        return zlib.compressobj(9, zlib.DEFLATED, 31)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs the zstandard package, install the zstd extra")
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unknown compression {encoding}")
+
+def decompressor(encoding: typing.Optional[str]):
+    """A decompressobj for the given Content-Encoding, or None if it isn't compressed."""
+    if encoding is None:
+        return None
+    if encoding == "gzip":
+        return zlib.decompressobj(31)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd decompression needs the zstandard package, install the zstd extra")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown compression {encoding}")
+
+def json_pieces(data, size: int = JSON_PIECE) -> list:
+    """data split up to be json encoded piece by piece, see TranscriptManager.encode_json.
+    bytes are json already, the other pieces are lists and dicts whose json goes in without its outer brackets.
+    Put together, the pieces are exactly what json.dumps(data) would give.
+    Dicts and lists of more than size elements are sliced, and dicts are split around their values that are.
+    """
+    pieces: list = []
+    if isinstance(data, (dict, list)) and len(data) > size:
+        elements = iter(data.items()) if isinstance(data, dict) else iter(data)
+        slice_type = dict if isinstance(data, dict) else list
+        pieces.append(b"{" if isinstance(data, dict) else b"[")
+        while piece := slice_type(itertools.islice(elements, size)):
+            if len(pieces) > 1:
+                pieces.append(b", ")
+            pieces.append(piece)
+        pieces.append(b"}" if isinstance(data, dict) else b"]")
+    elif isinstance(data, dict) and any(isinstance(value, (dict, list)) and len(value) > size for value in data.values()):
+        pieces.append(b"{")
+        for idx, (key, value) in enumerate(data.items()):
+            pieces.append((b", " if idx else b"") + json.dumps(str(key)).encode("utf8") + b": ")
+            pieces.extend(json_pieces(value, size))
+        pieces.append(b"}")
+    else:
+        pieces.append([data])
+    return pieces
+
+def decode_pieces(raw: bytes, size: int = JSON_PIECE) -> list[tuple[tuple[str, ...], bytes]]:
+    """Decode json in a worker process, pickled in pieces for TranscriptManager.decode_json, the inverse of json_pieces.
+    Each piece is (path, pickled part): the first one is the value itself, the others are
+    merged into the dict or list at path. Dicts and lists of more than size elements are sliced,
+    and dicts are sent with empty stand-ins for their values that are.
+    """
+    pieces: list[tuple[tuple[str, ...], bytes]] = []
+
+    def big(value) -> bool:
+        return isinstance(value, (dict, list)) and len(value) > size
+
+    def split(path: tuple[str, ...], value):
+        if big(value):
+            elements = iter(value.items()) if isinstance(value, dict) else iter(value)
+            slice_type = dict if isinstance(value, dict) else list
+            while part := slice_type(itertools.islice(elements, size)):
+                pieces.append((path, pickle.dumps(part)))
+        elif isinstance(value, dict) and any(map(big, value.values())):
+            pieces.append((path, pickle.dumps({key: type(item)() if big(item) else item for key, item in value.items()})))
+            for key, item in value.items():
+                if big(item):
+                    split(path + (key,), item)
+        else:
+            pieces.append((path, pickle.dumps(value)))
+    split((), json.loads(raw))
+    return pieces
+
+def encode_piece(piece: typing.Union[list, dict]) -> bytes:
+    """The json of a piece from json_pieces, without its outer brackets. Run in a worker process."""
+    return json.dumps(piece).encode("utf8")[1:-1]
+
+def compress_json(parts: list[bytes], encoding: typing.Optional[str]) -> bytes:
+    json_data = b"".join(parts)
+    compress = compressor(encoding)
+    if compress is not None:
+        json_data = compress.compress(json_data) + compress.flush()
+    return json_data
+
+def encode_items(items: list) -> bytes:
+    """items as the comma separated elements of a json array, see JSONArrayWriter.extend."""
+    return b",".join(json.dumps(item).encode("utf8") for item in items)
+
+def sha1_hex(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+def avatar_url(author: dict) -> str:
+    """What author.avatar_url_as(static_format="png") gives, without building a discord.User."""
+    if author.get("avatar"):
+        ext = "gif" if author["avatar"].startswith("a_") else "png"
+        return f"{discord.Asset.BASE}/avatars/{author['id']}/{author['avatar']}.{ext}?size=1024"
+    return f"{discord.Asset.BASE}/embed/avatars/{int(author.get('discriminator') or 0) % 5}.png"
+
+def emoji_url(emoji: dict) -> str:
+    """What the url_as() of a custom emoji gives, without building a discord.PartialEmoji."""
+    ext = "gif" if emoji.get("animated") else "png"
+    return f"{discord.Asset.BASE}/emojis/{emoji['id']}.{ext}"
+
+def object_params(content_type: typing.Optional[str] = None, encoding: typing.Optional[str] = None) -> dict:
+    """Extra put_object/create_multipart_upload parameters for the given content type and encoding."""
+    params = {}
+    if content_type is not None:
+        params["ContentType"] = content_type
+    if encoding is not None:
+        params["ContentEncoding"] = encoding
+    return params
+
+def asset_path(url: str) -> str:
+    """The logical path of an asset: where it is on discord's CDN, under assets/."""
+    return os.path.join("assets", parse.urlparse(url).path.strip("/"))
+
+def embed_path(provider_path: str, url: str, name: str) -> str:
+    # Different embeds of the same provider need their own paths,
+    # so include a hash of where the file came from.
+    return os.path.join(provider_path, hashlib.sha1(url.encode()).hexdigest()[:16], name)
+
+def asset_refs(msg: dict) -> list[tuple[str, dict, tuple[str, ...], str, str]]:
+    """Every asset of a message json, as (kind, dict it is in, fields that link to it, url to save it from, logical path).
+    kind is one of "avatar", "sticker", "attachment", "embed" and "emoji".
+    Avatars aren't linked from the message itself, so they have no fields.
+    """
+    refs: list[tuple[str, dict, tuple[str, ...], str, str]] = []
+    if "author" in msg:
+        url = avatar_url(msg["author"])
+        refs.append(("avatar", msg["author"], (), url, asset_path(url)))
+    for sticker in msg.get("sticker_items", []):
+        url = f"https://media.discordapp.net/stickers/{sticker['id']}.png?size=256&passthrough=false"
+        refs.append(("sticker", sticker, ("url",), url, asset_path(url)))
+    for attachment in msg.get("attachments", []):
+        refs.append(("attachment", attachment, ("proxy_url", "url"), attachment["url"], asset_path(attachment["url"])))
+    for embed in msg.get("embeds", []):
+        provider_path = os.path.join("assets", "embeds", embed.get("provider", {}).get("name") or "unknown")
+        video_url = embed.get("video", {}).get("url")
+        if video_url:
+            refs.append(("embed", embed["video"], ("url",), video_url, embed_path(provider_path, video_url, "video.mp4")))
+        for media, name in [("thumbnail", "thumbnail.png"), ("image", "image.png")]:
+            proxy_url = embed.get(media, {}).get("proxy_url")
+            if proxy_url:
+                refs.append(("embed", embed[media], ("url", "proxy_url"), proxy_url, embed_path(provider_path, proxy_url, name)))
+    for reaction in msg.get("reactions", []):
+        if reaction["emoji"].get("id"):
+            url = emoji_url(reaction["emoji"])
+            refs.append(("emoji", reaction["emoji"], ("url",), url, asset_path(url)))
+    return refs
+
+def resolve_message(data: dict, rewrites: dict[str, str]) -> dict:
+    """A message from a channel's messages.orig.json as the archive shows it:
+    the urls of its saved assets replaced by their keys, from the channel's rewrites.json.
+    Assets that weren't saved (yet, or at all) keep their discord url. data itself isn't changed.
+    """
+    msg = copy_for_rewrite(data)
+    for _, target, fields, url, _ in asset_refs(msg):
+        key = rewrites.get(url)
+        if key is not None:
+            for field in fields:
+                target[field] = key
+    return msg
+
+def legacy_assets(data: dict, rewrites: dict[str, str]) -> dict[str, str]:
+    """logical path -> key of the saved assets of a message, for the assets.json of the legacy transcript format."""
+    return {path: rewrites[url] for _, _, _, url, path in asset_refs(data) if url in rewrites}
+
+def copy_for_rewrite(data: dict) -> dict:
+    """Copy a raw message just deep enough that resolve_message can rewrite its asset urls.
+    Only the attachments, sticker items, embed images/thumbnails/videos and reaction emoji
+    are copied, everything else is shared with data.
+    """
+    msg = dict(data)
+    if "attachments" in data:
+        msg["attachments"] = [dict(attachment) for attachment in data["attachments"]]
+    if "sticker_items" in data:
+        msg["sticker_items"] = [dict(sticker) for sticker in data["sticker_items"]]
+    if "embeds" in data:
+        embeds = []
+        for embed in data["embeds"]:
+            embed = dict(embed)
+            for media in ["image", "thumbnail", "video"]:
+                if media in embed:
+                    embed[media] = dict(embed[media])
+            embeds.append(embed)
+        msg["embeds"] = embeds
+    if "reactions" in data:
+        msg["reactions"] = [dict(reaction, emoji=dict(reaction["emoji"])) for reaction in data["reactions"]]
+    return msg
+
+class AssetTransferError(Exception):
+    """Saving an asset failed, even after retrying."""
+    def __init__(self, url: str, target_path: str, cause: BaseException) -> None:
+        # Timeouts (and cancelled background transfers) don't have a message
+        self.reason = str(cause) or type(cause).__name__
+        super().__init__(f"Failed to save {url}: {self.reason}")
+        self.url = url
+        self.target_path = target_path
+        self.cause = cause
+
+def retryable(e: Exception) -> bool:
+    """Whether a failed request to the CDN or the bucket might work when tried again."""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    if isinstance(e, botocore.exceptions.ClientError):
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 500)
+        return status >= 500 or status == 429 or e.response.get("Error", {}).get("Code") in ["SlowDown", "RequestTimeout"]
+    return isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError, botocore.exceptions.BotoCoreError))
+
+async def retrying(what: str, attempt: typing.Callable[[], typing.Awaitable[T]]) -> T:
+    """Await attempt() until it works, retrying transient failures with jittered exponential backoff."""
+    for number in range(1, config.export.asset_attempts + 1):
+        try:
+            return await attempt()
+        except Exception as e:
+            if not retryable(e) or number == config.export.asset_attempts:
+                raise
+            # Full jitter, so the transfers that failed together don't retry together
+            delay = random.uniform(0, config.export.asset_backoff * 2 ** (number - 1))
+            log.warning("%s failed (%s), retrying in %.1fs", what, e, delay)
+            await asyncio.sleep(delay)
+    raise AssertionError("asset_attempts must be at least 1")
+
+class AssetPool:
+    """Limits how many asset transfers run at once, both in total and per host.
+    The same pool is shared by every export, so that concurrent exports don't
+    multiply the load on the discord CDN.
+    """
+    def __init__(self, limit: int, host_limits: dict[str, int], default_host_limit: int) -> None:
+        self.limit = asyncio.Semaphore(limit)
+        self.host_limits = host_limits
+        self.default_host_limit = default_host_limit
+        self.hosts: dict[str, asyncio.Semaphore] = {}
+        self.transferred = 0
+        self.connector = aiohttp.TCPConnector(
+                limit=limit,
+                keepalive_timeout=60,
+                ttl_dns_cache=300)
+
+    def host_slot(self, url: str) -> asyncio.Semaphore:
+        host = parse.urlparse(url).hostname or ""
+        if host not in self.hosts:
+            self.hosts[host] = asyncio.Semaphore(self.host_limits.get(host, self.default_host_limit))
+        return self.hosts[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url: str):
+        # Take the host slot first, so we don't sit on a global slot while
+        # waiting for a busy host.
+        async with self.host_slot(url), self.limit:
+            yield
+        self.transferred += 1
+
+class MultipartWriter:
+    """Uploads an object while it is being written, in parts of PART_SIZE,
+    and hashes it along the way. Objects that end up smaller than a single
+    part are uploaded with save_contents instead.
+    """
+    # S3 wants parts of at least 5MiB, except for the last one
+    PART_SIZE = 8 * 1024 * 1024
+    # Written bytes are compressed and hashed off the event loop, in batches of this size
+    BATCH_SIZE = 1024 * 1024
+
+    def __init__(self, mgr: "TranscriptManager", target_path: str, s3,
+            content_type: typing.Optional[str] = None, encoding: typing.Optional[str] = None) -> None:
+        self.mgr = mgr
+        self.target_path = target_path
+        self.s3 = s3
+        self.params = object_params(content_type, encoding)
+        self.compressor = compressor(encoding)
+        # Written, but not yet compressed and hashed
+        self.raw = bytearray()
+        self.flushed = False
+        self.buffer = bytearray()
+        # Hash and size of the stored (so possibly compressed) bytes
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.upload_id: typing.Optional[str] = None
+        self.parts: list[dict] = []
+        # Parts are uploaded in the background, at most upload_parts at once
+        self.sending: list[asyncio.Future] = []
+        self.slots = asyncio.Semaphore(config.export.upload_parts)
+
+    async def write(self, data: bytes):
+        self.raw += data
+        if len(self.raw) >= self.BATCH_SIZE:
+            await self.encode()
+
+    async def encode(self, final: bool = False):
+        """Compress and hash what was written so far in a worker thread, and queue it for upload."""
+        raw = bytes(self.raw)
+        self.raw.clear()
+        data = await self.mgr.offload(self.encode_batch, raw, final)
+        self.size += len(data)
+        self.buffer += data
+        if len(self.buffer) >= self.PART_SIZE:
+            await self.upload_part()
+
+    def encode_batch(self, raw: bytes, final: bool) -> bytes:
+        # Runs in a worker thread, but never twice at once: every write waits for the previous one
+        if self.compressor is not None:
+            raw = self.compressor.compress(raw)
+            if final:
+                raw += self.compressor.flush()
+        self.sha1.update(raw)
+        return raw
+
+    async def flush(self):
+        """Finish the compressed stream, nothing can be written after this."""
+        if not self.flushed:
+            await self.encode(final=True)
+            self.flushed = True
+
+    async def upload_part(self):
+        """Start uploading the buffer as the next part, waiting while too many parts are in flight."""
+        if self.upload_id is None:
+            upload = await retrying(f"Starting upload of {self.target_path}", lambda: self.s3.create_multipart_upload(
+                    Bucket=config.s3.bucket_name, Key=self.target_path, **self.params))
+            self.upload_id = upload["UploadId"]
+        # Every part holds a slot until it is sent, see send_part
+        await self.slots.acquire()
+        try:
+            # Raise the error of any part that failed in the meantime
+            for sent in [sent for sent in self.sending if sent.done()]:
+                self.sending.remove(sent)
+                sent.result()
+        except BaseException:
+            # This slot never made it to a part
+            self.slots.release()
+            raise
+        part_number = len(self.parts) + 1
+        self.parts.append({"PartNumber": part_number})
+        self.sending.append(asyncio.ensure_future(self.send_part(self.parts[-1], bytes(self.buffer))))
+        self.buffer.clear()
+
+    async def send_part(self, part: dict, body: bytes):
+        try:
+            response = await retrying(f"Uploading part {part['PartNumber']} of {self.target_path}", lambda: self.s3.upload_part(
+                    Bucket=config.s3.bucket_name,
+                    Key=self.target_path,
+                    UploadId=self.upload_id,
+                    PartNumber=part["PartNumber"],
+                    Body=body))
+            part["ETag"] = response["ETag"]
+            self.mgr.uploaded_bytes += len(body)
+        finally:
+            self.slots.release()
+
+    async def wait_parts(self):
+        sending, self.sending = self.sending, []
+        await asyncio.gather(*sending)
+
+    async def abort(self):
+        for sent in self.sending:
+            sent.cancel()
+        await asyncio.gather(*self.sending, return_exceptions=True)
+        self.sending = []
+        if self.upload_id is not None:
+            await self.s3.abort_multipart_upload(Bucket=config.s3.bucket_name, Key=self.target_path, UploadId=self.upload_id)
+            self.upload_id = None
+
+    async def complete(self) -> dict:
+        """Upload what is left and complete the multipart upload, as is."""
+        await self.flush()
+        await self.upload_part()
+        await self.wait_parts()
+        done = await retrying(f"Completing upload of {self.target_path}", lambda: self.s3.complete_multipart_upload(
+                Bucket=config.s3.bucket_name,
+                Key=self.target_path,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts}))
+        self.upload_id = None
+        return done
+
+    async def close(self) -> str:
+        """Finish the upload, returns the sha1 of everything stored."""
+        await self.flush()
+        sha1 = self.sha1.hexdigest()
+        if self.upload_id is None:
+            await self.mgr.save_contents(self.target_path, bytes(self.buffer), self.s3, **self.params)
+            return sha1
+        if await self.mgr.prepare_replace(self.target_path, sha1, self.s3):
+            # Nothing changed, the parts we uploaded are simply dropped
+            await self.abort()
+            return sha1
+        done = await self.complete()
+        # The hash is only known now, so attach it with a server side copy
+        # and drop the version without it.
+        await retrying(f"Tagging {self.target_path}", lambda: self.s3.copy_object(
+                Bucket=config.s3.bucket_name,
+                Key=self.target_path,
+                CopySource={"Bucket": config.s3.bucket_name, "Key": self.target_path},
+                Metadata={"sha1": sha1},
+                MetadataDirective="REPLACE",
+                **self.params))
+        if "VersionId" in done:
+            await self.s3.delete_object(Bucket=config.s3.bucket_name, Key=self.target_path, VersionId=done["VersionId"])
+        self.mgr.record(self.target_path, sha1, self.size)
+        return sha1
+
+class JSONArrayWriter:
+    """Writes a json array one element at a time."""
+    def __init__(self, out: MultipartWriter) -> None:
+        self.out = out
+        self.count = 0
+        self.started = False
+
+    async def resume(self, chunks: typing.AsyncIterator[bytes], count: int):
+        """Continue a previously written array, streamed from chunks, that has count elements."""
+        # Hold back the end of the stream, as that is where the closing bracket is.
+        tail = b""
+        async for chunk in chunks:
+            data = tail + chunk
+            await self.out.write(data[:-16])
+            tail = data[-16:]
+        tail = tail.rstrip()
+        if not tail.endswith(b"]"):
+            raise ValueError(f"{self.out.target_path} is not a json array")
+        await self.out.write(tail[:-1])
+        self.count = count
+        self.started = True
+
+    async def append(self, item):
+        await self.extend([item])
+
+    async def extend(self, items: list):
+        """Append several items at once, serialized in a worker process."""
+        if not items:
+            return
+        data = await self.out.mgr.serialize(encode_items, items)
+        if not self.started:
+            await self.out.write(b"[")
+            self.started = True
+        if self.count:
+            await self.out.write(b",")
+        await self.out.write(data)
+        self.count += len(items)
+
+    async def close(self) -> str:
+        if not self.started:
+            await self.out.write(b"[")
+        await self.out.write(b"]")
+        return await self.out.close()
+
+class VersionCleaner:
+    """Deletes old versions of replaced objects, in batches of up to BATCH_SIZE per request.
+
+    Versions are queued with add() and deleted in the background once a
+    batch is full, so this happens while the replacements are uploading.
+    flush() deletes whatever is left and waits for all of it.
+    """
+    # The most delete_objects accepts at once
+    BATCH_SIZE = 1000
+
+    def __init__(self) -> None:
+        self.log = log.getChild("cleaner")
+        self.pending: list[dict] = []
+        self.deletes: set[asyncio.Future] = set()
+        self.deleted = 0
+        self.deleted_bytes = 0
+
+    def add(self, versions: list[dict], s3):
+        """Queue versions, as found by list_object_versions, for deletion."""
+        self.pending.extend(versions)
+        while len(self.pending) >= self.BATCH_SIZE:
+            self.start_delete(s3)
+
+    def start_delete(self, s3):
+        batch = self.pending[:self.BATCH_SIZE]
+        del self.pending[:self.BATCH_SIZE]
+        delete = asyncio.ensure_future(self.delete(batch, s3))
+        self.deletes.add(delete)
+        delete.add_done_callback(self.deletes.discard)
+
+    async def delete(self, batch: list[dict], s3):
+        result = await s3.delete_objects(
+                Bucket=config.s3.bucket_name,
+                Delete={
+                    "Objects": [{"Key": version["Key"], "VersionId": version["VersionId"]} for version in batch],
+                    "Quiet": True,
+                })
+        failed = {(error["Key"], error.get("VersionId")) for error in result.get("Errors", [])}
+        for error in result.get("Errors", []):
+            self.log.warning("Failed to delete %s (version %s): %s", error["Key"], error.get("VersionId"), error.get("Message"))
+        for version in batch:
+            if (version["Key"], version["VersionId"]) not in failed:
+                self.deleted += 1
+                # delete markers have no size
+                self.deleted_bytes += version.get("Size", 0)
+
+    async def flush(self, s3):
+        while self.pending:
+            self.start_delete(s3)
+        if self.deletes:
+            await asyncio.gather(*self.deletes)
+            self.log.info("Deleted %d old versions so far, %.1f MiB", self.deleted, self.deleted_bytes / 2**20)
+
+class Manifest:
+    """What an export changed in the bucket, so the archive only has to re-index that.
+
+    The manager records every object it writes or deletes in all running manifests.
+    Only the objects under the category's folder and the assets its
+    exported channels refer to end up in the manifest.
+    """
+    def __init__(self, category_name: str, folder: str) -> None:
+        self.category_name = category_name
+        self.folder = folder
+        # key -> {"key", "sha1", "size"}
+        self.written: dict[str, dict] = {}
+        self.channels: list[dict] = []
+        self.assets: set[str] = set()
+        self.deleted: set[str] = set()
+
+    def record(self, key: str, sha1: str, size: int):
+        self.written[key] = {"key": key, "sha1": sha1, "size": size}
+        self.deleted.discard(key)
+
+    def remove(self, key: str):
+        self.written.pop(key, None)
+        self.deleted.add(key)
+
+    def add_channel(self, name: str, folder: str, message_count: int, new_messages: int,
+            last_message_id: typing.Optional[int], assets: typing.Iterable[str], legacy: bool):
+        self.channels.append({
+            "name": name,
+            "folder": folder,
+            "message_count": message_count,
+            "new_messages": new_messages,
+            "last_message_id": last_message_id,
+            # see TRANSCRIPT_FORMAT, legacy is whether messages.json and assets.json are there too
+            "format": TRANSCRIPT_FORMAT,
+            "legacy": legacy,
+        })
+        self.assets.update(assets)
+
+    def objects(self) -> list[dict]:
+        prefixes = (self.folder + "/", SEARCH_INDEX + "/")
+        return [obj for key, obj in sorted(self.written.items()) if key.startswith(prefixes) or key in self.assets]
+
+    def deletions(self) -> list[str]:
+        return sorted(key for key in self.deleted if key.startswith(self.folder + "/"))
+
+def failure_entry(error: AssetTransferError, message_id: typing.Optional[int] = None) -> dict:
+    """How a failed asset is recorded in a channel's failures.json."""
+    return {"message_id": message_id, "url": error.url, "path": error.target_path, "error": error.reason}
+
+def manifest_chunks(manifests: list[Manifest], size: int) -> list[dict]:
+    """The manifests of one or more exports as a single sync, split up into requests of at most size objects each.
+    A sync of a single category also has its category_name and folder at the top level.
+    """
+    objects: dict[str, dict] = {}
+    channels: list[dict] = []
+    deleted: set[str] = set()
+    for manifest in manifests:
+        for obj in manifest.objects():
+            objects[obj["key"]] = obj
+        deleted.update(manifest.deletions())
+        channels.extend(dict(channel, category=manifest.category_name) for channel in manifest.channels)
+    ordered = [objects[key] for key in sorted(objects)]
+    parts = [ordered[i:i + size] for i in range(0, len(ordered), size)] or [[]]
+    categories = [{"name": manifest.category_name, "folder": manifest.folder} for manifest in manifests]
+    sync_id = uuid.uuid4().hex
+    chunks = []
+    for idx, part in enumerate(parts):
+        chunk = {
+            "categories": categories,
+            "sync_id": sync_id,
+            "chunk": idx,
+            "chunks": len(parts),
+            "channels": channels if idx == 0 else [],
+            "deleted": sorted(deleted) if idx == 0 else [],
+            "objects": part,
+        }
+        if len(manifests) == 1:
+            chunk["category_name"] = manifests[0].category_name
+            chunk["folder"] = manifests[0].folder
+        chunks.append(chunk)
+    return chunks
 
 class TranscriptManager:
-    def __init__(self, bot: discord.Client) -> None:
+    def __init__(self, bot: discord.Client, governor: ratelimit.Governor,
+            message_journal: typing.Optional[journal.Journal] = None) -> None:
         self.log = log.getChild("manager")
         self.bot = bot
-        self.session = aiohttp.ClientSession()
-        self.existing_assets = set()
+        self.governor = governor
+        self.journal = message_journal
+        self.pool = AssetPool(config.export.max_concurrency, config.export.host_limits, config.export.default_host_limit)
+        # Background transfers of large attachments only get a few of the pool's slots
+        self.deferred_slots = asyncio.Semaphore(config.export.deferred_transfers)
+        self.session = aiohttp.ClientSession(connector=self.pool.connector)
+        # Hashing and compression of exports happen here, so they don't hold up
+        # the event loop the gateway and slash commands run on. Both let go of the GIL.
+        self.cpu = concurrent.futures.ThreadPoolExecutor(config.export.cpu_workers, thread_name_prefix="export")
+        # json.dumps holds the GIL for as long as it runs, so a thread doing it still stalls
+        # the event loop: json is serialized in worker processes instead, see encode_json.
+        # Not forked, as the bot has threads of its own by then.
+        self.json_workers = concurrent.futures.ProcessPoolExecutor(config.export.json_processes,
+                mp_context=multiprocessing.get_context("forkserver"))
+        # target path -> transfer future, resolving to the url the asset can be found at
+        self.transfers: dict[str, asyncio.Future] = {}
+        # target path -> url, for the most recently saved assets
+        self.recent_assets: collections.OrderedDict[str, str] = collections.OrderedDict()
+        self.store = exportstate.ExportStore(config.export.state_db)
+        # content addressed keys we know are in the bucket
+        self.inventory = inventory.AssetInventory(
+                config.export.inventory_path,
+                ASSET_PREFIX,
+                config.export.inventory_capacity,
+                config.export.inventory_exact_limit,
+                config.export.inventory_max_age)
+        self.uploaded_bytes = 0
+        self.cleaner = VersionCleaner()
+        # manifests of the running exports
+        self.manifests: set[Manifest] = set()
+        # Exports of different categories update the global search index one at a time
+        self.index_lock = asyncio.Lock()
+
+    def interrupted_exports(self) -> list[tuple[discord.CategoryChannel, discord.TextChannel]]:
+        """The exports that were still running when the bot stopped, as (category, channel to report to)."""
+        exports = []
+        for export in self.store.interrupted():
+            category = self.bot.get_channel(export["category_id"])
+            channel = self.bot.get_channel(export["status_channel_id"])
+            if not isinstance(category, discord.CategoryChannel) or channel is None:
+                self.log.warning("Can't resume export of %s, its category or channel is gone", export["category_name"])
+                self.store.finish(export["id"], failed=True)
+                continue
+            exports.append((category, channel))
+        return exports
 
-    async def create(self, category: discord.CategoryChannel, ctx: discord_slash.SlashContext):
+    async def offload(self, fn: typing.Callable[..., T], *args) -> T:
+        """Run fn(*args) in a worker thread, for CPU heavy work that releases the GIL, like hashing and compression."""
+        return await asyncio.get_running_loop().run_in_executor(self.cpu, fn, *args)
+
+    async def serialize(self, fn: typing.Callable[..., T], *args) -> T:
+        """Run fn(*args) in a worker process, for CPU heavy work that holds the GIL, like json.dumps.
+        fn has to be a module level function. Pickling args still happens in this process
+        and holds the GIL too, so keep them small.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.json_workers, fn, *args)
+
+    async def encode_json(self, data, encoding: typing.Optional[str]) -> bytes:
+        """data as (compressed) json, in one go so the hash is over the bytes we actually store.
+        Big data is encoded in pieces (see json_pieces), so none of them is pickled for long
+        on its way to a worker process, and the event loop gets to run in between.
+        """
+        # Slicing up big data takes a while too, but in short steps that a thread takes turns with the loop on
+        pieces = await self.offload(json_pieces, data)
+        encoded = iter(await asyncio.gather(*(self.serialize(encode_piece, piece)
+                for piece in pieces if not isinstance(piece, bytes))))
+        parts = [piece if isinstance(piece, bytes) else next(encoded) for piece in pieces]
+        return await self.offload(compress_json, parts, encoding)
+
+    async def decode_json(self, raw: bytes):
+        """The json in raw, decoded in a worker process (see decode_pieces).
+        Big data comes back in pieces, so none of them is unpickled for long on the event loop.
+        """
+        pieces = await self.serialize(decode_pieces, raw)
+        data = pickle.loads(pieces[0][1])
+        for path, part in pieces[1:]:
+            await asyncio.sleep(0)
+            container = data
+            for key in path:
+                container = container[key]
+            if isinstance(container, dict):
+                container.update(pickle.loads(part))
+            else:
+                container.extend(pickle.loads(part))
+        return data
+
+    def open_s3(self):
+        """A client for the archive bucket, to be used as an async context manager."""
         session = aiobotocore.get_session()
-        async with session.create_client('s3',
-                endpoint_url='https://s3.us-west-002.backblazeb2.com',
+        return session.create_client('s3',
+                endpoint_url=config.s3.endpoint_url,
                 aws_access_key_id = config.s3.keyID,
-                aws_secret_access_key = config.s3.key) as s3:
+                aws_secret_access_key = config.s3.key,
+                config=aiobotocore.config.AioConfig(max_pool_connections=config.export.max_concurrency))
+
+    async def create(self, category: discord.CategoryChannel, ctx: typing.Union[discord_slash.SlashContext, discord.TextChannel],
+            job: typing.Optional[jobs.Job] = None):
+        async with self.open_s3() as s3:
             self.log.info("Creating transcript for %s", category.name)
             trans = Transcript(self, category, ctx)
-            await trans.build(s3)
-            await trans.sync_to_archive()
+            if job is not None:
+                job.progress = trans.summary
+            await self.inventory.refresh(s3, config.s3.bucket_name)
+            self.manifests.update([trans.manifest, trans.late_manifest])
+            try:
+                try:
+                    await trans.build(s3)
+                finally:
+                    self.manifests.discard(trans.manifest)
+                    self.inventory.save()
+                    await self.cleaner.flush(s3)
+                await trans.sync_to_archive()
+                # The transcripts are in the archive by now, the large attachments follow
+                if await trans.finish_deferred(s3):
+                    await trans.sync_to_archive(trans.late_manifest)
+            finally:
+                self.manifests.discard(trans.late_manifest)
+                trans.cancel_deferred()
 
-    def get_target_path(self, url: str) -> str:
-        discord_parsed = parse.urlparse(url)
-        target_path = discord_parsed.path.strip("/")
-        target_path = os.path.join("assets", target_path)
-        return target_path
+    async def create_many(self, categories: list[discord.CategoryChannel], channel: discord.TextChannel,
+            job: typing.Optional[jobs.Job] = None):
+        """Export several categories as one: with one s3 client, sharing the asset transfers
+        and the concurrency limits, and with a single archive sync at the end.
+        """
+        names = ", ".join(category.name for category in categories)
+        async with self.open_s3() as s3:
+            self.log.info("Creating transcripts for %s", names)
+            transcripts = [Transcript(self, category, channel) for category in categories]
+            if job is not None:
+                job.progress = lambda: "; ".join(f"{trans.category.name}: {trans.summary()}" for trans in transcripts)
+            await self.inventory.refresh(s3, config.s3.bucket_name)
+            self.manifests.update(trans.manifest for trans in transcripts)
+            self.manifests.update(trans.late_manifest for trans in transcripts)
+            try:
+                try:
+                    await asyncio.gather(*(trans.build(s3) for trans in transcripts))
+                finally:
+                    self.manifests.difference_update(trans.manifest for trans in transcripts)
+                    self.inventory.save()
+                    await self.cleaner.flush(s3)
+                await self.sync_many(names, [trans.manifest for trans in transcripts], channel)
+                for trans in transcripts:
+                    await trans.update_status(f"{trans.status}\nSynced to the archive along with {names}", done=True)
+                late = await asyncio.gather(*(trans.finish_deferred(s3) for trans in transcripts))
+                if any(late):
+                    await self.sync_many(names, [trans.late_manifest for trans, deferred in zip(transcripts, late) if deferred], channel)
+            finally:
+                self.manifests.difference_update(trans.late_manifest for trans in transcripts)
+                for trans in transcripts:
+                    trans.cancel_deferred()
+                    # Don't leave the status writers running when the sync failed
+                    trans.stop_status()
 
-    async def save_contents(self, target_path: str, contents: bytes, s3):
-        sha1 = hashlib.sha1(contents).hexdigest()
-        # delete any pre-existing assets.
-        existing_ok = False
-        self.log.info("Saving asset to %s", target_path)
-        response: dict = await s3.list_objects_v2(Bucket=config.s3.bucket_name, Prefix=target_path)
-        for existing in response.get("Contents", []):
-            # self.log.info("Have existing %s", existing)
-            key = existing["Key"]
-            obj = await s3.head_object(
-                Bucket=config.s3.bucket_name,
-                Key=key
-            )
-            # self.log.info("Have existing obj: %s", obj)
-            existing_sha1 = None
-            if "Metadata" in obj:
-                if "sha1" in obj["Metadata"]:
-                    existing_sha1 = obj["Metadata"]["sha1"]
-            if existing_sha1 != sha1:
-                self.log.info("Deleting out of date %s", target_path)
-                versions: dict = await s3.list_object_versions(
-                    Bucket=config.s3.bucket_name,
-                    Prefix=target_path
-                )
-                for version in versions.get("Versions", []) + versions.get("DeleteMarkers", []):
-                    await s3.delete_object(Bucket=config.s3.bucket_name, Key=key, VersionId=version["VersionId"])
-            else:
-                self.log.info("Found existing one: %s (%s, %s)", target_path, existing_sha1, sha1)
-                return key
+    async def sync_many(self, names: str, manifests: list[Manifest], channel: discord.TextChannel):
+        await channel.send(f"Syncing {names} to the archive")
+        try:
+            objects = await self.sync_to_archive(manifests)
+        except Exception as e:
+            log.exception(f"Failed to sync {names} to the archive")
+            await channel.send(f"Failed to sync {names} to the archive: {e}")
+            raise
+        await channel.send(f"Synced {names} to the archive ({objects} changed objects)")
+
+    async def sync_to_archive(self, manifests: list[Manifest]) -> int:
+        """Tell the archive what one or more exports changed, in signed chunks of their manifests.
+        Returns the number of changed objects.
+        """
+        chunks = manifest_chunks(manifests, config.archive.manifest_chunk)
+        objects = sum(len(chunk["objects"]) for chunk in chunks)
+        names = ", ".join(manifest.category_name for manifest in manifests)
+        log.info(f"Syncing {names} to the archive: {objects} objects in {len(chunks)} requests")
+        url = urllib.parse.urljoin(config.archive.url, 'update')
+        for chunk in chunks:
+            await self.post_signed(url, chunk)
+        return objects
+
+    async def post_signed(self, url: str, payload: dict):
+        """POST payload signed with the archive secret, retrying with exponential backoff."""
+        body = json.dumps(payload).encode()
+        signature = hmac.new(config.archive.secret, body, digestmod=hashlib.sha256).hexdigest()
+        headers = {"Content-Type": "application/json", "X-Signature": signature}
+        timeout = aiohttp.ClientTimeout(total=10*60)
+        for attempt in range(1, config.archive.sync_attempts + 1):
+            try:
+                async with self.session.post(url, headers=headers, data=body, timeout=timeout) as r:
+                    r.raise_for_status()
+                    log.debug(f"Archive server replied with {await r.text()}")
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # Retrying won't fix a request the archive refuses
+                refused = isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 and e.status != 429
+                if refused or attempt == config.archive.sync_attempts:
+                    raise
+                delay = config.archive.sync_backoff * 2 ** (attempt - 1)
+                log.warning("Sync request to the archive failed (%s), retrying in %.0fs", e, delay)
+                await asyncio.sleep(delay)
 
-        await s3.put_object(Bucket=config.s3.bucket_name, Key=target_path, Body=contents, Metadata={"sha1" : sha1})
+    async def estimate(self, category: discord.CategoryChannel, channel: discord.TextChannel,
+            job: typing.Optional[jobs.Job] = None):
+        """Estimate what exporting category would take, without exporting it, and report to channel."""
+        async with self.open_s3() as s3:
+            trans = Transcript(self, category, channel)
+            if job is not None:
+                job.progress = trans.summary
+            await self.inventory.refresh(s3, config.s3.bucket_name)
+            report = await trans.estimate(s3)
+        await channel.send(report)
 
-    async def save_asset(self, discord_url: discord.Asset, s3) -> str:
-        """Save an asset found at discord_url to assets/path_from_discord_url.
-        Returns the URL to access the asset at.
+    def message_assets(self, data: dict) -> list[tuple[str, str, typing.Optional[int]]]:
+        """(url, logical path, size if known) of the assets save_msg_contents would save for a message json."""
+        return [(url, path, target.get("size") if kind == "attachment" else None)
+                for kind, target, _, url, path in asset_refs(data)
+                if kind != "attachment" or target.get("size", 0) <= config.export.max_attachment_bytes]
+
+    def get_content_key(self, sha1: str, target_path: str) -> str:
+        """Where an asset with the given hash lives in the bucket.
+        The extension of target_path is kept, so the archive can still serve it with a sensible content type.
+        """
+        _, ext = os.path.splitext(target_path)
+        if not ext[1:].isalnum() or len(ext) > 8:
+            ext = ""
+        return os.path.join(ASSET_PREFIX, sha1[:2], sha1 + ext.lower())
+
+    async def head(self, key: str, s3) -> typing.Optional[dict]:
+        """head_object, returning None if the object doesn't exist."""
+        try:
+            return await s3.head_object(Bucket=config.s3.bucket_name, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            raise
+
+    async def prepare_replace(self, target_path: str, sha1: str, s3) -> bool:
+        """Check whether target_path already holds an object with the given hash.
+        If it holds something else instead, all its current versions are queued
+        for deletion, which happens while the replacement is uploaded.
+
+        Returns
+        -------
+        bool
+            True if the object is already up to date.
+        """
+        existing = await self.head(target_path, s3)
+        if existing is None:
+            return False
+        existing_sha1 = existing.get("Metadata", {}).get("sha1")
+        if existing_sha1 == sha1:
+            self.log.info("Found existing one: %s (%s, %s)", target_path, existing_sha1, sha1)
+            return True
+        self.log.info("Deleting out of date %s", target_path)
+        self.cleaner.add(await self.old_versions(target_path, s3), s3)
+        return False
+
+    async def old_versions(self, target_path: str, s3) -> list[dict]:
+        """All versions and delete markers of exactly target_path."""
+        versions = []
+        paginator = s3.get_paginator("list_object_versions")
+        async for page in paginator.paginate(Bucket=config.s3.bucket_name, Prefix=target_path):
+            for version in page.get("Versions", []) + page.get("DeleteMarkers", []):
+                # The listing is by prefix, so it can include other keys.
+                # Without versioning there is only the "null" version, which the upload overwrites.
+                if version["Key"] == target_path and version["VersionId"] != "null":
+                    versions.append(version)
+        return versions
+
+    async def delete(self, target_path: str, s3):
+        """Delete target_path, along with all its old versions, and tell the manifests of running exports."""
+        await s3.delete_object(Bucket=config.s3.bucket_name, Key=target_path)
+        self.cleaner.add(await self.old_versions(target_path, s3), s3)
+        for manifest in self.manifests:
+            manifest.remove(target_path)
+
+    def record(self, key: str, sha1: str, size: int):
+        """Note an object that was written to the bucket, for the manifests of running exports."""
+        for manifest in self.manifests:
+            manifest.record(key, sha1, size)
+
+    async def save_contents(self, target_path: str, contents: bytes, s3, **params):
+        """Save contents to target_path, unless it is already there.
+        params are passed on to put_object, for e.g. the ContentType.
+        """
+        sha1 = await self.offload(sha1_hex, contents)
+        self.log.info("Saving to %s", target_path)
+        if not await self.prepare_replace(target_path, sha1, s3):
+            await retrying(f"Saving {target_path}", lambda: s3.put_object(
+                    Bucket=config.s3.bucket_name, Key=target_path, Body=contents, Metadata={"sha1" : sha1}, **params))
+            self.uploaded_bytes += len(contents)
+            self.record(target_path, sha1, len(contents))
+        return target_path
+
+    async def save_asset_contents(self, target_path: str, contents: bytes, s3) -> str:
+        """Store an asset by its content hash, so identical files are only uploaded once.
 
         Parameters
         ----------
-        discord_url : str
-            [description]
         target_path : str
-            [description]
+            The logical path of the asset, only used for its extension.
+        contents : bytes
+            The asset itself.
 
         Returns
         -------
         str
-            [description]
+            The key the asset is stored at.
         """
-        # no need to download again!
-        target_path = self.get_target_path(discord_url._url)
-        if target_path in self.existing_assets:
-            return target_path
-        self.existing_assets.add(target_path)
-        
-        # self.log.info("Uploading from %s to %s", discord_url, target_path)
-        # response = self.session.get(discord_url)
-        contents = await discord_url.read()
-        await self.save_contents(target_path, contents, s3)
-        return target_path
+        sha1 = await self.offload(sha1_hex, contents)
+        key = self.get_content_key(sha1, target_path)
+        # The key is derived from the contents, so if it exists it's the same file.
+        if not await self.asset_exists(key, s3):
+            self.log.info("Saving asset %s to %s", target_path, key)
+            await s3.put_object(Bucket=config.s3.bucket_name, Key=key, Body=contents, Metadata={"sha1" : sha1})
+            self.uploaded_bytes += len(contents)
+            self.record(key, sha1, len(contents))
+        else:
+            self.log.info("Found existing asset %s at %s", target_path, key)
+        self.inventory.add(key)
+        return key
 
-    async def save_url(self, url: str, s3, target_path=None) -> str:
-        if target_path is None:
-            target_path = self.get_target_path(url)
-        if target_path in self.existing_assets:
-            return target_path
-        self.existing_assets.add(target_path)
-        async with self.session.get(url) as resp:
-            if resp.status in [404, 401, 403, 415]:
-                return url
-            resp.raise_for_status()
-            contents = await resp.content.read()
-            log.info("Downloaded contents %s: %d", url, len(contents))
-            await self.save_contents(target_path, contents, s3)
-            return target_path
-
-    async def save_msg_contents(self, message: discord.message.Message, msg: dict, s3) -> dict:
-        """Saves any contents found in message and changes the url if need be.
+    async def asset_exists(self, key: str, s3) -> bool:
+        """Whether a content addressed asset is in the bucket, only asking the bucket if the inventory doesn't know."""
+        known = self.inventory.contains(key)
+        if known is None:
+            known = await self.head(key, s3) is not None
+        return known
+
+    async def stream_asset_contents(self, target_path: str, chunks: typing.AsyncIterator[bytes], s3) -> str:
+        """Like save_asset_contents, but for assets that are too large to keep in memory.
+        The asset is uploaded to a temporary key while it comes in, and moved to
+        its content addressed key once the hash is known.
 
         Parameters
         ----------
-        msg : dict
-            [description]
+        target_path : str
+            The logical path of the asset, only used for its extension.
+        chunks : AsyncIterator[bytes]
+            The asset, piece by piece.
 
         Returns
         -------
-        dict
-            [description]
+        str
+            The key the asset is stored at.
         """
-        author: discord.User = message.author
-        await self.save_asset(author.avatar_url_as(static_format="png"), s3)
-        #todo save emojis!
-        if "sticker_items" in msg:
-            for idx, sticker in enumerate(msg["sticker_items"]):
-                # log.info("Have sticker: %s, %s", sticker, sticker.image_url_as())
-                url = f"https://media.discordapp.net/stickers/{sticker['id']}.png?size=256&passthrough=false"
-                new_url = await self.save_url(url, s3)
-                msg["sticker_items"][idx]["url"] = new_url
-        for idx, attachment in enumerate(message.attachments):
-            new_url = await self.save_url(attachment.url, s3)
-            msg["attachments"][idx]["proxy_url"] = new_url
-            msg["attachments"][idx]["url"] = new_url
-        for idx, embed in enumerate(message.embeds):
-            embed: discord.Embed
-            provider = embed.provider.name
-            if provider is discord.Embed.Empty:
-                provider = "unknown"
-            # log.info("Saving embed %s", embed)
-            url_parsed = parse.urlparse(embed.url)
-            base_path = os.path.basename(url_parsed.path)
-            target_path = os.path.join("assets", "embeds", provider)
-            # log.info("Target path: %s", target_path)
-            # log.info("Video: %s. Thumb: %s. Image: %s", embed.video.url, embed.thumbnail.proxy_url, embed.image.proxy_url)
-            embed_dict = msg["embeds"][idx]
-            if embed.video.url is not discord.Embed.Empty:
-                video_path = os.path.join(target_path, "video.mp4")
-                new_url = await self.save_url(embed.video.url, s3, video_path)
-                embed_dict["video"]["url"] = new_url
-            if embed.thumbnail.proxy_url is not discord.Embed.Empty:
-                new_url = await self.save_url(embed.thumbnail.proxy_url, s3, os.path.join(target_path, "thumbnail.png"))
-                embed_dict["thumbnail"]["url"] = new_url
-                embed_dict["thumbnail"]["proxy_url"] = new_url
-            if embed.image.proxy_url is not discord.Embed.Empty:
-                # self.log.info("Embed image: %s", embed.image)
-                new_url = await self.save_url(embed.image.proxy_url, s3, os.path.join(target_path, "image.png"))
-                embed_dict["image"]["url"] = new_url
-                embed_dict["image"]["proxy_url"] = new_url
-            msg["embeds"][idx] = embed_dict
-        for idx, reaction in enumerate(message.reactions):
-            if reaction.custom_emoji:
-                new_url = await self.save_asset(reaction.emoji.url_as(), s3)
-                msg["reactions"][idx]["emoji"]["url"] = new_url
-        return msg
+        incoming = MultipartWriter(self, os.path.join("assets", "incoming", uuid.uuid4().hex), s3)
+        try:
+            async for chunk in chunks:
+                await incoming.write(chunk)
+            await incoming.flush()
+            if incoming.upload_id is None:
+                # Turned out small enough after all
+                return await self.save_asset_contents(target_path, bytes(incoming.buffer), s3)
+            sha1 = incoming.sha1.hexdigest()
+            key = self.get_content_key(sha1, target_path)
+            log.info("Streamed contents of %s: %d", target_path, incoming.size)
+            if await self.asset_exists(key, s3):
+                self.log.info("Found existing asset %s at %s", target_path, key)
+                await incoming.abort()
+            else:
+                self.log.info("Saving asset %s to %s", target_path, key)
+                done = await incoming.complete()
+                await s3.copy_object(
+                        Bucket=config.s3.bucket_name,
+                        Key=key,
+                        CopySource={"Bucket": config.s3.bucket_name, "Key": incoming.target_path},
+                        Metadata={"sha1": sha1},
+                        MetadataDirective="REPLACE")
+                version = {"VersionId": done["VersionId"]} if "VersionId" in done else {}
+                await s3.delete_object(Bucket=config.s3.bucket_name, Key=incoming.target_path, **version)
+                self.record(key, sha1, incoming.size)
+            self.inventory.add(key)
+            return key
+        except BaseException:
+            await incoming.abort()
+            raise
+
+    async def save_url(self, url: str, s3, target_path=None, rewrites: typing.Optional[dict] = None) -> str:
+        if target_path is None:
+            target_path = asset_path(url)
+        # no need to download again, and if someone else is already busy
+        # downloading it, just wait for them.
+        if target_path in self.recent_assets:
+            self.recent_assets.move_to_end(target_path)
+            key = self.recent_assets[target_path]
+        else:
+            if target_path not in self.transfers:
+                self.transfers[target_path] = asyncio.ensure_future(self.transfer_url(url, s3, target_path))
+            try:
+                key = await asyncio.shield(self.transfers[target_path])
+            finally:
+                # failures aren't remembered, so a later export can try again
+                transfer = self.transfers.pop(target_path, None)
+            if transfer is not None:
+                self.recent_assets[target_path] = key
+                while len(self.recent_assets) > config.export.recent_assets:
+                    self.recent_assets.popitem(last=False)
+        if rewrites is not None and key != url:
+            rewrites[url] = key
+        return key
+
+    async def transfer_url(self, url: str, s3, target_path: str) -> str:
+        try:
+            return await retrying(f"Saving {url}", lambda: self.try_transfer_url(url, s3, target_path))
+        except Exception as e:
+            raise AssetTransferError(url, target_path, e) from e
+
+    async def try_transfer_url(self, url: str, s3, target_path: str) -> str:
+        async with self.pool.slot(url):
+            async with self.session.get(url) as resp:
+                if resp.status in [404, 401, 403, 415]:
+                    return url
+                resp.raise_for_status()
+                if resp.content_length is None or resp.content_length > config.export.stream_threshold:
+                    return await self.stream_asset_contents(target_path, resp.content.iter_chunked(64 * 1024), s3)
+                contents = await resp.content.read()
+                log.info("Downloaded contents %s: %d", url, len(contents))
+                return await self.save_asset_contents(target_path, contents, s3)
+
+    def defer_url(self, url: str, s3, target_path: str) -> asyncio.Future:
+        """Save an asset in the background, behind at most deferred_transfers others.
+        The future resolves to the same as save_url.
+        """
+        async def transfer():
+            async with self.deferred_slots:
+                return await self.save_url(url, s3, target_path)
+        return asyncio.ensure_future(transfer())
+
+    async def save_msg_contents(self, data: dict, s3, rewrites: typing.Optional[dict] = None,
+            deferred: typing.Optional[dict] = None, failures: typing.Optional[list] = None):
+        """Saves any assets found in a message json, the json itself is left as it is (see resolve_message).
+        Works on the json alone, building discord.py models for every message is too slow for big exports.
+
+        Attachments larger than inline_attachment_bytes are only saved here without deferred,
+        otherwise they are started in the background. Attachments larger than max_attachment_bytes
+        are never saved, they keep pointing at discord.
+
+        Parameters
+        ----------
+        data : dict
+            The message json.
+        rewrites : dict, optional
+            Mapping of urls to the keys of the assets saved from them, any saved assets are added to it.
+        deferred : dict, optional
+            Mapping of logical asset paths to (url, future from defer_url), for the attachments that are saved in the background.
+        failures : list, optional
+            If given, assets that fail to save are added to it (see failure_entry),
+            instead of failing the whole message.
+        """
+        # All transfers of a message run at once
+        transfers = []
+        for kind, target, _, url, path in asset_refs(data):
+            if kind == "attachment":
+                size = target.get("size", 0)
+                if size > config.export.max_attachment_bytes:
+                    continue
+                if deferred is not None and size > config.export.inline_attachment_bytes:
+                    if path not in deferred and (rewrites is None or url not in rewrites):
+                        deferred[path] = (url, self.defer_url(url, s3, path))
+                    continue
+            transfers.append(self.save_url(url, s3, path, rewrites))
+        results = await asyncio.gather(*transfers, return_exceptions=failures is not None)
+        for result in results:
+            if isinstance(result, AssetTransferError) and failures is not None:
+                # Keeps its discord url, a later export retries it
+                failures.append(failure_entry(result, int(data["id"])))
+            elif isinstance(result, BaseException):
+                raise result
 
     async def save_json(self, data, filepath, s3):
         # self.log.info("Saving json to %s", filepath)
-        json_data = json.dumps(data).encode("utf8")
-        await self.save_contents(filepath, json_data, s3)
+        json_data = await self.encode_json(data, config.export.compression)
+        await self.save_contents(filepath, json_data, s3, **object_params("application/json", config.export.compression))
+
+    async def merge_search_index(self, category_name: str, index: search.CategoryIndex, s3):
+        """Replace what the global search index knows about a category with its new index.
+
+        The global index has the same shards as the category indexes, mapping
+        token -> category -> message count, and a categories.json with the
+        meta of every category index.
+        """
+        counts: list[dict[str, int]] = [{} for _ in range(index.shards)]
+        for token, count in index.token_counts().items():
+            counts[search.shard_of(token, index.shards)][token] = count
+
+        async def merge_shard(shard: int):
+            path = os.path.join(SEARCH_INDEX, "tokens", f"{shard}.json")
+            merged = search.merge_global(await self.load_json(path, s3) or {}, category_name, counts[shard])
+            await self.save_json(merged, path, s3)
+
+        async with self.index_lock:
+            await asyncio.gather(*map(merge_shard, range(index.shards)))
+            categories_path = os.path.join(SEARCH_INDEX, "categories.json")
+            categories = await self.load_json(categories_path, s3) or {}
+            categories[category_name] = index.meta()
+            await self.save_json(categories, categories_path, s3)
+
+    def json_writer(self, filepath, s3) -> JSONArrayWriter:
+        """A streaming writer for a json array at filepath."""
+        return JSONArrayWriter(MultipartWriter(self, filepath, s3, "application/json", config.export.compression))
+
+    async def read_object(self, filepath, s3) -> typing.Optional[typing.AsyncIterator[bytes]]:
+        """Stream the (decompressed) contents of an object, or None if it doesn't exist."""
+        try:
+            response = await s3.get_object(Bucket=config.s3.bucket_name, Key=filepath)
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            raise
+        decompress = decompressor(response.get("ContentEncoding"))
 
+        async def chunks():
+            async with response["Body"] as body:
+                while chunk := await body.read(MultipartWriter.PART_SIZE):
+                    yield chunk if decompress is None else decompress.decompress(chunk)
+            if decompress is not None:
+                yield decompress.flush()
+        return chunks()
+
+    async def load_json(self, filepath, s3):
+        """Load a json object we saved before, or None if it doesn't exist."""
+        chunks = await self.read_object(filepath, s3)
+        if chunks is None:
+            return None
+        return await self.decode_json(b"".join([chunk async for chunk in chunks]))
+
+    async def resume_json_array(self, writer: JSONArrayWriter, filepath, count: int, s3) -> bool:
+        """Stream a previously saved json array into writer, so more elements can be appended.
+        Returns False if there was nothing to resume from.
+        """
+        chunks = await self.read_object(filepath, s3)
+        if chunks is None:
+            return False
+        await writer.resume(chunks, count)
+        return True
+
+
+class ExportProgress:
+    """Keeps track of how far along an export is.
+    How far a channel is, is estimated from the snowflake of the last exported message,
+    relative to the range of snowflakes that still had to be exported.
+    """
+    def __init__(self, mgr: TranscriptManager, channels: int) -> None:
+        self.mgr = mgr
+        self.started = time.monotonic()
+        self.channels = channels
+        self.messages = 0
+        self.start_assets = mgr.pool.transferred
+        self.start_bytes = mgr.uploaded_bytes
+        self.start_deleted_bytes = mgr.cleaner.deleted_bytes
+        # assets that couldn't be saved, for the failure budget
+        self.failed_assets = 0
+        # channel name -> (first snowflake, last snowflake, current snowflake)
+        self.active: dict[str, tuple[int, int, int]] = {}
+        self.done: set[str] = set()
+
+    @property
+    def assets(self) -> int:
+        return self.mgr.pool.transferred - self.start_assets
+
+    @property
+    def uploaded_bytes(self) -> int:
+        return self.mgr.uploaded_bytes - self.start_bytes
+
+    @property
+    def deleted_bytes(self) -> int:
+        return self.mgr.cleaner.deleted_bytes - self.start_deleted_bytes
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def start_channel(self, name: str, first: int, last: int):
+        self.active[name] = (first, last, first)
+
+    def advance(self, name: str, message_id: int):
+        self.messages += 1
+        first, last, _ = self.active[name]
+        self.active[name] = (first, max(last, message_id), message_id)
+
+    def finish_channel(self, name: str):
+        self.active.pop(name, None)
+        self.done.add(name)
+
+    @staticmethod
+    def channel_fraction(first: int, last: int, current: int) -> float:
+        if last <= first:
+            return 1.0
+        return min(1.0, (current - first) / (last - first))
+
+    def fraction(self) -> float:
+        partial = sum(self.channel_fraction(*span) for span in self.active.values())
+        return (len(self.done) + partial) / max(1, self.channels)
+
+    def eta(self) -> typing.Optional[float]:
+        fraction = self.fraction()
+        if fraction <= 0:
+            return None
+        return self.elapsed * (1 - fraction) / fraction
+
+    def summary(self) -> str:
+        eta = self.eta()
+        return (f"{self.fraction():.0%}, {len(self.done)}/{self.channels} channels"
+                + (f", ETA {eta:.0f}s" if eta is not None else ""))
+
+    def bar(self, width: int = 20, max_channels: int = 10) -> str:
+        filled = round(self.fraction() * width)
+        lines = [
+            f"`[{'#' * filled}{'.' * (width - filled)}]` {self.summary()}",
+            f"{self.messages} messages ({self.messages / max(self.elapsed, 1e-3):.1f}/s), "
+            f"{self.assets} assets, {self.uploaded_bytes / 2**20:.1f} MiB uploaded, "
+            f"{self.deleted_bytes / 2**20:.1f} MiB of old versions deleted",
+        ]
+        if self.failed_assets:
+            lines.append(f"{self.failed_assets} assets failed to save (budget {config.export.asset_failure_budget})")
+        for name, span in sorted(self.active.items())[:max_channels]:
+            lines.append(f"- {name}: {self.channel_fraction(*span):.0%}")
+        if len(self.active) > max_channels:
+            lines.append(f"- and {len(self.active) - max_channels} more")
+        return "\n".join(lines)
+
+class PageSpool:
+    """A queue of history pages that a range crawler never has to wait on.
+    The first pages are kept in memory, once that is full the rest go to a temporary file
+    until the export gets to them, so later ranges can run ahead as far as they need.
+    """
+    def __init__(self, memory_pages: int) -> None:
+        self.memory_pages = memory_pages
+        self.memory: collections.deque[typing.Optional[list[dict]]] = collections.deque()
+        self.file: typing.Optional[typing.BinaryIO] = None
+        self.read_pos = 0
+        self.spooled = 0
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    def put(self, page: typing.Optional[list[dict]]):
+        """Add a page, or None once the range is done."""
+        if self.closed:
+            return
+        if self.spooled or len(self.memory) >= self.memory_pages:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile()
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(json.dumps(page).encode("utf8") + b"\n")
+            self.spooled += 1
+        else:
+            self.memory.append(page)
+        self.ready.set()
+
+    async def get(self) -> typing.Optional[list[dict]]:
+        while not self.memory and not self.spooled:
+            self.ready.clear()
+            await self.ready.wait()
+        if self.memory:
+            return self.memory.popleft()
+        assert self.file is not None
+        self.file.seek(self.read_pos)
+        line = self.file.readline()
+        self.read_pos = self.file.tell()
+        self.spooled -= 1
+        if not self.spooled:
+            # Start over, so the file doesn't grow beyond what's still spooled
+            self.file.truncate(0)
+            self.read_pos = 0
+        return json.loads(line)
+
+    def close(self):
+        self.closed = True
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 class Transcript:
-    def __init__(self, mgr: TranscriptManager, category: discord.CategoryChannel, ctx: discord_slash.SlashContext) -> None:
+    def __init__(self, mgr: TranscriptManager, category: discord.CategoryChannel,
+            ctx: typing.Union[discord_slash.SlashContext, discord.TextChannel]) -> None:
+        """ctx is either the slash command that started the export,
+        or the channel to report to when resuming an export without one.
+        """
         self.log = log.getChild("maker")
         self.category = category
         self.mgr = mgr
         self.ctx = ctx
+        self.status_channel = ctx.channel if isinstance(ctx, discord_slash.SlashContext) else ctx
+        self.export_id: typing.Optional[int] = None
         self.status_msg = None
-        self.progress = None
-        ctx.author.avatar_url
+        self.status = ""
+        # what the status message currently says
+        self.status_content: typing.Optional[str] = None
+        self.status_writer: typing.Optional[asyncio.Task] = None
+        self.progress: typing.Optional[ExportProgress] = None
         self.json_folder = os.path.join("archive", "ctf", category.name)
+        self.manifest = Manifest(category.name, self.json_folder)
+        # What the background transfers change, synced once they are done
+        self.late_manifest = Manifest(category.name, self.json_folder)
+        # channel id -> {"name", "folder", "rewrites", "assets", "state", "failures", "transfers": {logical path: (url, future)}},
+        # for the channels with assets still being saved in the background
+        self.deferred: dict[int, dict] = {}
+        # search indexes of the channels exported in this run
+        self.channel_indexes: dict[int, search.ChannelIndex] = {}
 
     @property
     def http(self) -> discord.http.HTTPClient:
         return self.mgr.bot.http
 
+    def summary(self) -> str:
+        if self.progress is None:
+            return self.status
+        return self.progress.summary()
 
-    async def update_status(self, status, done=False):
+    def render_status(self) -> str:
         status_msg = f"""Exporting Category {self.category.name} {config.mgmt.loading_emoji}
-{status}
+{self.status}
 """
-        
         if self.progress is not None:
             status_msg += self.progress.bar()
-        if done:
-            status_msg = status
+        # discord's message length limit
+        return status_msg[:2000]
+
+    async def publish_status(self, content: str):
+        if content == self.status_content:
+            return
+        self.status_content = content
         if self.status_msg is None:
-            self.status_msg = await self.ctx.send(status_msg)
+            self.status_msg = await self.ctx.send(content)
         else:
-            await self.status_msg.edit(content=status_msg)
+            await self.mgr.governor.submit("status_edit", self.status_msg.channel.id, self.status_msg.edit, content=content)
 
-    async def build_messages(self, channel: discord.TextChannel, s3) -> list:
-        """Builds a list of message json objects, that are found inside channel.
-        It also downloads any found attachments to s3 and replaces the links to them.
+    async def write_status(self):
+        """Coalesces all status updates and progress into at most one edit every status_interval."""
+        while True:
+            await asyncio.sleep(config.export.status_interval)
+            try:
+                await self.publish_status(self.render_status())
+            except Exception:
+                log.exception("Failed to update the export status")
+
+    def stop_status(self):
+        """Stop refreshing the status message, it keeps what it said last."""
+        if self.status_writer is not None:
+            self.status_writer.cancel()
+            self.status_writer = None
+
+    async def update_status(self, status, done=False):
+        self.status = status
+        if done:
+            self.stop_status()
+            await self.publish_status(status)
+        elif self.status_msg is None:
+            await self.publish_status(self.render_status())
+        elif self.status_writer is None:
+            self.status_writer = asyncio.ensure_future(self.write_status())
+
+    async def history_page(self, channel: discord.TextChannel, after: int) -> list[dict]:
+        """The (up to) 100 messages right after the given snowflake, oldest first."""
+        page = await self.mgr.governor.submit("history", channel.id, self.http.logs_from, channel.id, 100, after=after)
+        return sorted(page, key=lambda data: int(data["id"]))
+
+    async def crawl_range(self, channel: discord.TextChannel, after: int, until: typing.Optional[int], out: PageSpool):
+        """Put all pages of messages with after < id <= until into out, oldest first, followed by None."""
+        try:
+            while True:
+                page = await self.history_page(channel, after)
+                done = len(page) < 100
+                if until is not None:
+                    done = done or (bool(page) and int(page[-1]["id"]) >= until)
+                    page = [data for data in page if int(data["id"]) <= until]
+                if page:
+                    out.put(page)
+                    after = int(page[-1]["id"])
+                if done:
+                    break
+        finally:
+            out.put(None)
+
+    async def crawl_history(self, channel: discord.TextChannel, after: int, last_id: typing.Optional[int],
+            until: typing.Optional[int] = None):
+        """Yields the json of every message after the given snowflake
+        (and up to until, if given), oldest first.
+
+        Big channels are split up into ranges of snowflakes that are crawled
+        concurrently. How many ranges is estimated from how much time the
+        first page of messages covers, and capped by how many concurrent
+        history requests the governor allows. Ranges ahead of the one being
+        exported spool their pages, see PageSpool.
+        """
+        end = last_id if until is None else until
+        first = await self.history_page(channel, after)
+        if until is not None:
+            first = [data for data in first if int(data["id"]) <= until]
+        pages: list[PageSpool] = []
+        crawlers: list[asyncio.Future] = []
+        if len(first) == 100 and end is not None and int(first[-1]["id"]) < end:
+            start = int(first[-1]["id"])
+            estimated = 100 * (end - after) / max(1, start - after)
+            ranges = min(self.mgr.governor.limit("history"), max(1, int(estimated // config.export.range_messages)))
+            starts = [start + (end - start) * i // ranges for i in range(ranges)]
+            self.log.info("Crawling ~%d messages of %s in %d ranges", estimated, channel.name, ranges)
+            for lo, hi in zip(starts, starts[1:] + [until]):
+                spool = PageSpool(config.export.range_prefetch_pages)
+                pages.append(spool)
+                crawlers.append(asyncio.ensure_future(self.crawl_range(channel, lo, hi, spool)))
+        try:
+            for data in first:
+                yield data
+            for spool in pages:
+                while (page := await spool.get()) is not None:
+                    for data in page:
+                        yield data
+            # Surface any errors of the crawlers
+            await asyncio.gather(*crawlers)
+        finally:
+            for crawler in crawlers:
+                crawler.cancel()
+            for spool in pages:
+                spool.close()
+
+    async def history(self, channel: discord.TextChannel, after: typing.Optional[int], last_id: typing.Optional[int]):
+        """Yields the json of every message after the given snowflake, oldest first.
+
+        Messages are taken from the journal for the snowflakes it covers,
+        only the gaps in between are crawled.
+        """
+        if after is None:
+            # Nothing can be older than the channel itself
+            after = channel.id
+        message_journal = self.mgr.journal
+        covered = []
+        if message_journal is not None and last_id is not None:
+            covered = message_journal.covered(channel.id, after, last_id)
+        if message_journal is None or not covered:
+            async for item in self.crawl_history(channel, after, last_id):
+                yield item
+            return
+        # Only where each message's events are is kept in memory,
+        # the messages themselves are replayed a page at a time
+        loop = asyncio.get_running_loop()
+        snapshot = message_journal.snapshot(channel.id)
+        events, scanned = await loop.run_in_executor(None, message_journal.events, channel.id, snapshot)
+        message_journal.add_index(scanned)
+        located = await loop.run_in_executor(None, journal.locate, events, covered[0][0], covered[-1][1])
+        from_journal = 0
+        for lo, hi in covered:
+            if after < lo:
+                async for item in self.crawl_history(channel, after, lo, until=lo):
+                    yield item
+            ids = sorted(message_id for message_id in located if lo < message_id <= hi)
+            for start in range(0, len(ids), 100):
+                page = await loop.run_in_executor(None, journal.replay, events,
+                        [located.pop(message_id) for message_id in ids[start:start + 100]])
+                for data in page:
+                    from_journal += 1
+                    yield data
+            after = hi
+        async for item in self.crawl_history(channel, after, last_id):
+            yield item
+        self.log.info("Took %d messages of %s from the journal", from_journal, channel.name)
+
+    async def build_messages(self, channel: discord.TextChannel, s3):
+        """Builds the message json objects that are found inside channel, and streams them to s3.
+        It also downloads any found attachments to s3, and keeps track of where they went in rewrites.json.
 
         Parameters
         ----------
         channel : discord.TextChannel
             The channel where to build from.            
-
-        Returns
-        -------
-        list
-            List of message json objects.
         """
+        assert self.export_id is not None and self.progress is not None, "build_messages is run by build"
         try:
             channel_folder = os.path.join(self.json_folder, channel.name)
             self.log.info("Building messages for channel %s, %s", channel.name, type(channel._state))
-            await self.update_status(f"Exporting {channel.name}")
-            message: discord.message.Message
-            og_msgs = []
-            changed_msgs = []
+            self.mgr.store.update_channel(self.export_id, channel.id, channel.name, exportstate.RUNNING)
             channel_meta = os.path.join(channel_folder, "meta.json")
-            channel_json = await self.http.get_channel(channel.id)
+            channel_json = await self.mgr.governor.submit("get_channel", channel.id, self.http.get_channel, channel.id)
             await self.mgr.save_json(channel_json, channel_meta, s3)
-            async for item in json_history(channel, oldest_first=True):
-                message, data = item
-                # self.log.info("Retrieved message: %s (%s)", message, data)
-                changed = await self.mgr.save_msg_contents(message, copy.deepcopy(data), s3)
-                changed_msgs.append(changed)
-                og_msgs.append(data)
-            messages_path = os.path.join(channel_folder, "messages.json")
-            await self.mgr.save_json(changed_msgs, messages_path, s3)
+
             orig_path = os.path.join(channel_folder, "messages.orig.json")
-            await self.mgr.save_json(og_msgs, orig_path, s3)
+            rewrites_path = os.path.join(channel_folder, "rewrites.json")
+            # The legacy format, see config.archive.legacy_transcripts
+            legacy = config.archive.legacy_transcripts
+            messages_path = os.path.join(channel_folder, "messages.json")
+            assets_path = os.path.join(channel_folder, "assets.json")
+            index_path = os.path.join(channel_folder, "index.json")
+            state_path = os.path.join(channel_folder, "state.json")
+            failures_path = os.path.join(channel_folder, "failures.json")
+            # High-water mark of the previous export, so we only need to get newer messages.
+            state = await self.mgr.load_json(state_path, s3)
+            outdated = state is not None and state.get("format") != TRANSCRIPT_FORMAT
+            # Transcripts from before the format had messages.json and assets.json
+            had_legacy = state is not None and (outdated or state.get("legacy", False))
+            if outdated:
+                self.log.info("Transcript of %s is in an older format, redoing it", channel.name)
+                state = None
+            last_message_id = channel_json.get("last_message_id")
+            if (state is not None and (last_message_id is None or int(last_message_id) == state["last_message_id"])
+                    and (had_legacy or not legacy)):
+                self.log.info("Channel %s didn't change since the last export, skipping", channel.name)
+                if had_legacy and not legacy:
+                    await self.drop_legacy(channel_folder, s3)
+                    state["legacy"] = False
+                    await self.mgr.save_json(state, state_path, s3)
+                if state.get("deferred"):
+                    # Retry the large attachments the last export didn't get to, and the assets that failed
+                    skipped_rewrites = await self.mgr.load_json(rewrites_path, s3) or {}
+                    skipped_assets = (await self.mgr.load_json(assets_path, s3) or {}) if legacy else None
+                    previous_failures = await self.mgr.load_json(failures_path, s3) or []
+                    self.defer_channel(channel, channel_folder, skipped_rewrites, skipped_assets, state, previous_failures,
+                            {path: (url, self.mgr.defer_url(url, s3, path)) for path, url in state["deferred"].items()})
+                self.mgr.store.update_channel(self.export_id, channel.id, channel.name, exportstate.DONE,
+                        state["last_message_id"], state["message_count"])
+                self.progress.finish_channel(channel.name)
+                return
+            first_id = channel.id
+            if state is not None and state["last_message_id"] is not None:
+                first_id = state["last_message_id"]
+            self.progress.start_channel(channel.name, first_id, int(last_message_id or first_id))
+
+            # The transcript is streamed to s3 while the history comes in,
+            # so we never have to hold a whole channel in memory.
+            og_msgs = self.mgr.json_writer(orig_path, s3)
+            legacy_msgs = self.mgr.json_writer(messages_path, s3) if legacy else None
+            after = None
+            last_exported = None
+            previous_count = 0
+            index = search.ChannelIndex()
+            # url -> content addressed key of the asset saved from it, see resolve_message
+            rewrites: dict[str, str] = {}
+            # logical asset path -> content addressed key, for the legacy assets.json
+            assets: typing.Optional[dict[str, str]] = {} if legacy else None
+            # logical asset path -> (url, transfer), for the large attachments saved in the background
+            deferred: dict[str, tuple[str, asyncio.Future]] = {}
+            # assets that failed to save, see failure_entry
+            failures: list[dict] = []
+            # Messages whose assets are still in flight, oldest first.
+            # A message is only added to the transcript once its assets are done.
+            pending: collections.deque = collections.deque()
+            uploader: typing.Optional[asyncio.Future] = None
+            try:
+                if state is not None:
+                    previous_rewrites = await self.mgr.load_json(rewrites_path, s3)
+                    previous_assets = await self.mgr.load_json(assets_path, s3) if legacy and had_legacy else None
+                    if (previous_rewrites is not None
+                            and (legacy_msgs is None or previous_assets is not None)
+                            and await self.mgr.resume_json_array(og_msgs, orig_path, state["message_count"], s3)
+                            and (legacy_msgs is None
+                                or await self.mgr.resume_json_array(legacy_msgs, messages_path, state["message_count"], s3))):
+                        rewrites = previous_rewrites
+                        if legacy:
+                            assets = previous_assets
+                        index = search.ChannelIndex(await self.mgr.load_json(index_path, s3))
+                        for path, url in state.get("deferred", {}).items():
+                            deferred[path] = (url, self.mgr.defer_url(url, s3, path))
+                        if state.get("failures"):
+                            failures = await self.mgr.load_json(failures_path, s3) or []
+                        last_exported = state["last_message_id"]
+                        after = last_exported
+                        previous_count = state["message_count"]
+                        self.log.info("Resuming export of %s after %d messages", channel.name, state["message_count"])
+                    else:
+                        self.log.warning("Missing previous transcript for %s, doing a full export", channel.name)
+                        await og_msgs.out.abort()
+                        og_msgs = self.mgr.json_writer(orig_path, s3)
+                        if legacy_msgs is not None:
+                            await legacy_msgs.out.abort()
+                            legacy_msgs = self.mgr.json_writer(messages_path, s3)
+
+                # The export is a pipeline: history pages are fetched ahead (see crawl_history),
+                # the assets of up to message_window messages are transferred at once,
+                # and finished messages go to the upload stage through a bounded queue.
+                # Every stage waits for the next one when that falls behind, so memory stays bounded.
+                finished: asyncio.Queue = asyncio.Queue(config.export.message_window)
+
+                async def upload():
+                    nonlocal last_exported
+                    done = False
+                    while not done:
+                        # Whatever piled up is serialized in one go
+                        batch = [await finished.get()]
+                        while not finished.empty():
+                            batch.append(finished.get_nowait())
+                        if batch[-1] is None:
+                            batch.pop()
+                            done = True
+                        await og_msgs.extend(batch)
+                        if legacy_msgs is not None and assets is not None:
+                            await legacy_msgs.extend([resolve_message(data, rewrites) for data in batch])
+                            for data in batch:
+                                assets.update(legacy_assets(data, rewrites))
+                        for data in batch:
+                            index.add(data)
+                            self.progress.advance(channel.name, int(data["id"]))
+                            last_exported = int(data["id"])
+                    await og_msgs.close()
+                    if legacy_msgs is not None:
+                        await legacy_msgs.close()
+                uploader = asyncio.ensure_future(upload())
+
+                async def hand_off(item):
+                    if uploader.done():
+                        # Surface why the uploads stopped
+                        uploader.result()
+                    if not finished.full():
+                        finished.put_nowait(item)
+                        return
+                    put = asyncio.ensure_future(finished.put(item))
+                    await asyncio.wait([put, uploader], return_when=asyncio.FIRST_COMPLETED)
+                    if not put.done():
+                        put.cancel()
+                        uploader.result()
+
+                # The failures of earlier exports don't count against this one's budget
+                counted = len(failures)
+
+                async def finish_oldest():
+                    nonlocal counted
+                    data, saving = pending.popleft()
+                    await saving
+                    if len(failures) > counted:
+                        self.progress.failed_assets += len(failures) - counted
+                        counted = len(failures)
+                        if self.progress.failed_assets > config.export.asset_failure_budget:
+                            raise RuntimeError(f"More than {config.export.asset_failure_budget} assets failed to save, giving up")
+                    await hand_off(data)
+
+                last_id = int(last_message_id) if last_message_id is not None else None
+                async for data in self.history(channel, after, last_id):
+                    saving = asyncio.ensure_future(self.mgr.save_msg_contents(data, s3, rewrites, deferred, failures))
+                    pending.append((data, saving))
+                    if len(pending) >= config.export.message_window:
+                        await finish_oldest()
+                while pending:
+                    await finish_oldest()
+                await hand_off(None)
+                await uploader
+            except BaseException:
+                for _, saving in pending:
+                    saving.cancel()
+                for _, transfer in deferred.values():
+                    transfer.cancel()
+                if uploader is not None:
+                    uploader.cancel()
+                    await asyncio.gather(uploader, return_exceptions=True)
+                await og_msgs.out.abort()
+                if legacy_msgs is not None:
+                    await legacy_msgs.out.abort()
+                raise
+            await self.mgr.save_json(rewrites, rewrites_path, s3)
+            if assets is not None:
+                await self.mgr.save_json(assets, assets_path, s3)
+            await self.mgr.save_json(index.to_json(), index_path, s3)
+            if failures or (state is not None and state.get("failures")):
+                await self.mgr.save_json(failures, failures_path, s3)
+            self.channel_indexes[channel.id] = index
+            # The channel's last message may have been deleted, so also take
+            # that into account to avoid refetching an unchanged channel next time.
+            marks = [mark for mark in [last_exported, last_message_id] if mark is not None]
+            new_state: dict[str, typing.Any] = {
+                "format": TRANSCRIPT_FORMAT,
+                "legacy": legacy,
+                "last_message_id": max(map(int, marks), default=None),
+                "message_count": og_msgs.count,
+                # So a later export can retry them, if this one doesn't get to finish them
+                "deferred": dict([(failure["path"], failure["url"]) for failure in failures]
+                    + [(path, url) for path, (url, _) in deferred.items()]),
+                "failures": len(failures),
+                }
+            # Written last, so an interrupted export is simply redone next time.
+            await self.mgr.save_json(new_state, state_path, s3)
+            if had_legacy and not legacy:
+                await self.drop_legacy(channel_folder, s3)
+            self.mgr.store.update_channel(self.export_id, channel.id, channel.name, exportstate.DONE,
+                    new_state["last_message_id"], new_state["message_count"])
+            self.manifest.add_channel(channel.name, channel_folder, og_msgs.count, og_msgs.count - previous_count,
+                    new_state["last_message_id"], rewrites.values(), legacy)
+            if deferred:
+                self.defer_channel(channel, channel_folder, rewrites, assets, new_state, failures, deferred)
+            self.progress.finish_channel(channel.name)
         except Exception as e:
             log.exception("Failed to build transcript for channel %s", channel.name)
-            await self.ctx.channel.send(f"Failed to build transcript for channel {channel.name}: {e}")
+            self.mgr.store.update_channel(self.export_id, channel.id, channel.name, exportstate.FAILED, error=str(e))
+            await self.status_channel.send(f"Failed to build transcript for channel {channel.name}: {e}")
             # self.update_status(f"Failed to build transcript for channel {channel.name}")
             raise
-        # with open("test.json", "w") as f:
-        #     json.dump(changed_msgs, f, indent=4, sort_keys=True)
-        # with open("originals.json", "w") as f:
-        #     json.dump(og_msgs, f, indent=4, sort_keys=True)
 
     async def build(self, s3):
         self.log.info("Building Transcript")
+        self.export_id = self.mgr.store.start(self.category.id, self.category.name, self.status_channel.id)
+        # When picking up an interrupted export, the channels that made it are only redone
+        # if they got new messages in the meantime
+        done = self.mgr.store.done_channels(self.export_id)
+        channels = [channel for channel in self.category.channels
+                if channel.id not in done or channel.last_message_id != done[channel.id]]
+        if len(channels) < len(self.category.channels):
+            self.log.info("Skipping %d channels that were already exported", len(self.category.channels) - len(channels))
+        self.progress = ExportProgress(self.mgr, len(channels))
         await self.update_status("Building Transcript")
         try:
-            category_channel = await self.http.get_channel(self.category.id)
+            category_channel = await self.mgr.governor.submit("get_channel", self.category.id, self.http.get_channel, self.category.id)
             category_json = os.path.join(self.json_folder, "meta.json")
             await self.mgr.save_json(category_channel, category_json, s3)
             channel_waits = []
-            for channel in self.category.channels:
+            for channel in channels:
                 channel_waits.append(self.build_messages(channel, s3))
-            await asyncio.gather(*channel_waits)
-        except:
+            # A failing channel shouldn't take the others down with it
+            results = await asyncio.gather(*channel_waits, return_exceptions=True)
+            try:
+                await self.write_search_index(s3)
+            except Exception:
+                # The transcripts themselves are fine, the index is rebuilt by the next export
+                log.exception("Failed to write the search index of %s", self.category.name)
+                await self.status_channel.send(f"Failed to write the search index of {self.category.name}")
+            await self.mgr.cleaner.flush(s3)
+        except asyncio.CancelledError:
+            log.info("Export of %s was cancelled", self.category.name)
+            self.mgr.store.finish(self.export_id, failed=True)
+            await self.update_status(f"Export of {self.category.name} was cancelled", True)
+            raise
+        except Exception:
             log.exception("Failed to build transcript")
+            self.mgr.store.finish(self.export_id, failed=True)
             await self.update_status("Failed to build transcript!", True)
             return
-        log.info("Finished with transcript")
-        await self.update_status(f"Finished Building Transcript for {self.category.name}")
+        failed = [channel.name for channel, result in zip(channels, results) if isinstance(result, BaseException)]
+        self.mgr.store.finish(self.export_id, failed=bool(failed), messages=self.progress.messages,
+                assets=self.progress.assets, uploaded_bytes=self.progress.uploaded_bytes)
+        progress = self.progress
+        rate = (f"{progress.assets} assets in {progress.elapsed:.1f}s ({progress.assets / progress.elapsed:.1f} assets/s), "
+                f"{progress.deleted_bytes / 2**20:.1f} MiB of old versions deleted")
+        if progress.failed_assets:
+            rate += f", {progress.failed_assets} assets failed (see failures.json, the next export retries them)"
+        log.info("Finished with transcript: %s", rate)
+        if failed:
+            await self.update_status(f"Finished Building Transcript for {self.category.name}: {rate}\n"
+                    f"Failed channels: {', '.join(failed)}. Run /export again to retry them, the unchanged channels are skipped.")
+        else:
+            await self.update_status(f"Finished Building Transcript for {self.category.name}: {rate}")
 
-    async def sync_to_archive(self):
-        body = json.dumps({"category_name": self.category.name}).encode()
-        signature = hmac.new(config.archive.secret, body, digestmod=hashlib.sha256).hexdigest()
-        headers = {"Content-Type": "application/json", "X-Signature": signature}
+    async def estimate_channel(self, channel: discord.TextChannel, s3) -> dict:
+        """Estimate the work of exporting a channel from its metadata and (at most) two sampled pages of history:
+        the oldest messages that would be exported and the newest ones.
+        """
+        estimate: dict[str, typing.Any] = {"unchanged": False, "messages": 0, "sampled": 0, "assets": 0, "known_assets": 0,
+                "attachment_bytes": 0, "requests": 1}
+        channel_json = await self.mgr.governor.submit("get_channel", channel.id, self.http.get_channel, channel.id)
+        last_message_id = channel_json.get("last_message_id")
+        state = await self.mgr.load_json(os.path.join(self.json_folder, channel.name, "state.json"), s3)
+        after = channel.id
+        previous_rewrites: dict[str, str] = {}
+        if state is not None and state.get("format") == TRANSCRIPT_FORMAT:
+            if last_message_id is None or int(last_message_id) == state["last_message_id"]:
+                estimate["unchanged"] = True
+                return estimate
+            # An empty channel was exported without a last message
+            if state["last_message_id"] is not None:
+                after = state["last_message_id"]
+            previous_rewrites = await self.mgr.load_json(os.path.join(self.json_folder, channel.name, "rewrites.json"), s3) or {}
+        if last_message_id is None:
+            return estimate
+        last = int(last_message_id)
+        sample = await self.history_page(channel, after)
+        estimate["requests"] += 1
+        messages = float(len(sample))
+        if len(sample) == 100:
+            newest = await self.mgr.governor.submit("history", channel.id, self.http.logs_from, channel.id, 100)
+            estimate["requests"] += 1
+            newest = sorted((data for data in newest if int(data["id"]) > int(sample[-1]["id"])), key=lambda data: int(data["id"]))
+            if len(newest) < 100:
+                # The two pages overlap, so we've seen everything
+                messages += len(newest)
+            else:
+                # Assume the density of messages in between is that of the two pages
+                span = (int(sample[-1]["id"]) - after) + (int(newest[-1]["id"]) - int(newest[0]["id"]))
+                messages = max(200, 200 * (last - after) / max(1, span))
+            sample.extend(newest)
+        estimate["messages"] = messages
+        estimate["sampled"] = len(sample)
+        scale = messages / max(1, len(sample))
+        seen: set[str] = set()
+        for data in sample:
+            for url, path, size in self.mgr.message_assets(data):
+                if path in seen:
+                    continue
+                seen.add(path)
+                # Attachments and embeds are new with every message, avatars and emoji mostly repeat
+                weight = scale if path.startswith(("assets/attachments", "assets/embeds")) else 1
+                estimate["assets"] += weight
+                estimate["attachment_bytes"] += (size or 0) * weight
+                if url in previous_rewrites or path in self.mgr.recent_assets:
+                    estimate["known_assets"] += weight
+        return estimate
 
-        log.info(f"Syncing category {self.category.name} to the archive")
-        await self.update_status(f"Syncing category {self.category.name} to the archive")
+    async def estimate(self, s3) -> str:
+        """A report of what exporting the category would take."""
+        channels = list(self.category.channels)
+        estimated = 0
+
+        async def estimate_channel(channel):
+            nonlocal estimated
+            try:
+                return await self.estimate_channel(channel, s3)
+            finally:
+                estimated += 1
+                self.status = f"Estimated {estimated}/{len(channels)} channels"
+
+        self.status = f"Estimating {len(channels)} channels"
+        results = await asyncio.gather(*map(estimate_channel, channels), return_exceptions=True)
+        failed = [channel.name for channel, result in zip(channels, results) if isinstance(result, BaseException)]
+        for result in results:
+            if isinstance(result, BaseException):
+                log.error("Failed to estimate a channel of %s", self.category.name, exc_info=result)
+        estimates = [result for result in results if not isinstance(result, BaseException)]
+        total = {key: sum(estimate[key] for estimate in estimates)
+                for key in ["messages", "assets", "known_assets", "attachment_bytes", "requests"]}
+        unchanged = sum(estimate["unchanged"] for estimate in estimates)
+        new_assets = total["assets"] - total["known_assets"]
+        # Every page of 100 messages, and the meta of every channel
+        requests = total["messages"] / 100 + len(channels) + 1
+
+        lines = [
+            f"Estimate for exporting {self.category.name} (sampled {total['requests']} requests):",
+            f"{len(channels)} channels, {unchanged} unchanged since the last export",
+            f"~{total['messages']:.0f} messages to export, ~{requests:.0f} discord requests",
+            f"~{total['assets']:.0f} distinct assets, ~{total['known_assets']:.0f} of them already saved, "
+            f"~{total['attachment_bytes'] / 2**20:.1f} MiB of attachments",
+            f"{self.mgr.inventory.count} assets in the bucket",
+        ]
+        throughput = self.mgr.store.throughput()
+        if throughput is not None:
+            message_rate, asset_rate = throughput
+            seconds = max(total["messages"] / max(message_rate, 1e-3), new_assets / max(asset_rate, 1e-3))
+            lines.append(f"~{datetime.timedelta(seconds=round(seconds))}, going by recent exports "
+                    f"({message_rate:.1f} messages/s, {asset_rate:.1f} assets/s)")
+        else:
+            # Without earlier exports, all we know is how fast we may crawl
+            seconds = requests / config.ratelimit.bulk_rate
+            lines.append(f"at least ~{datetime.timedelta(seconds=round(seconds))} to crawl the history, no recent exports to go by")
+        if failed:
+            lines.append(f"Couldn't estimate: {', '.join(failed)}")
+        return "\n".join(lines)[:2000]
 
+    async def write_search_index(self, s3):
+        """Merge the indexes of all channels into the category's search index, next to its transcripts,
+        and that into the global search index.
+        """
+        await self.update_status("Writing the search index")
+        index = search.CategoryIndex(config.export.index_shards)
+        for channel in self.category.channels:
+            channel_index = self.channel_indexes.get(channel.id)
+            if channel_index is None:
+                # Not exported in this run, so take the index of the last export
+                data = await self.mgr.load_json(os.path.join(self.json_folder, channel.name, "index.json"), s3)
+                if data is None:
+                    continue
+                channel_index = search.ChannelIndex(data)
+            index.add(channel.name, channel_index)
+        folder = os.path.join(self.json_folder, "index")
+        saves = [self.mgr.save_json(shard, os.path.join(folder, "tokens", f"{idx}.json"), s3)
+                for idx, shard in enumerate(index.tokens)]
+        saves.append(self.mgr.save_json(index.authors, os.path.join(folder, "authors.json"), s3))
+        saves.append(self.mgr.save_json(index.dates, os.path.join(folder, "dates.json"), s3))
+        saves.append(self.mgr.save_json(index.meta(), os.path.join(folder, "meta.json"), s3))
+        await asyncio.gather(*saves)
+        await self.mgr.merge_search_index(self.category.name, index, s3)
+
+    def defer_channel(self, channel: discord.TextChannel, folder: str, rewrites: dict, assets: typing.Optional[dict],
+            state: dict, failures: list[dict], transfers: dict[str, tuple[str, asyncio.Future]]):
+        """Remember a channel that still has assets being saved in the background, for finish_deferred.
+        assets is its legacy assets.json, if it has one.
+        """
+        self.deferred[channel.id] = {"name": channel.name, "folder": folder, "rewrites": rewrites, "assets": assets,
+                "state": state, "failures": failures, "transfers": transfers}
+
+    async def drop_legacy(self, folder: str, s3):
+        """Delete the messages.json and assets.json of a channel, now that the archive reads rewrites.json."""
+        self.log.info("Deleting the legacy transcript in %s", folder)
+        for name in ["messages.json", "assets.json"]:
+            await self.mgr.delete(os.path.join(folder, name), s3)
+
+    async def rewrite_legacy(self, folder: str, rewrites: dict[str, str], s3):
+        """Write the legacy messages.json of a channel again, with the assets saved in the background resolved."""
+        messages = await self.mgr.load_json(os.path.join(folder, "messages.orig.json"), s3) or []
+        writer = self.mgr.json_writer(os.path.join(folder, "messages.json"), s3)
+        try:
+            for start in range(0, len(messages), 100):
+                await writer.extend([resolve_message(data, rewrites) for data in messages[start:start + 100]])
+            await writer.close()
+        except BaseException:
+            await writer.out.abort()
+            raise
+
+    def cancel_deferred(self):
+        for channel in self.deferred.values():
+            for _, transfer in channel["transfers"].values():
+                transfer.cancel()
+
+    async def finish_deferred(self, s3) -> bool:
+        """Wait for the assets that are saved in the background, and add them to their channels' rewrites.
+        Returns whether there were any, so late_manifest needs to be synced.
+        """
+        if not self.deferred:
+            return False
+        count = sum(len(channel["transfers"]) for channel in self.deferred.values())
+        await self.update_status(f"Saving {count} assets of {self.category.name} in the background", done=True)
+        # What the first sync already covered doesn't have to be sent again
+        for obj in self.manifest.objects():
+            self.late_manifest.written.pop(obj["key"], None)
+
+        failed = 0
+        for channel in self.deferred.values():
+            saved = 0
+            paths = list(channel["transfers"])
+            results = await asyncio.gather(*(transfer for _, transfer in channel["transfers"].values()), return_exceptions=True)
+            failures = [failure for failure in channel["failures"] if failure["path"] not in channel["transfers"]]
+            for path, result in zip(paths, results):
+                url, _ = channel["transfers"][path]
+                if isinstance(result, BaseException):
+                    log.error("Failed to save %s of %s in the background", url, channel["name"], exc_info=result)
+                    if not isinstance(result, AssetTransferError):
+                        result = AssetTransferError(url, path, result)
+                    failures.append(failure_entry(result))
+                    failed += 1
+                elif result != url:
+                    channel["rewrites"][url] = result
+                    saved += 1
+                    if channel["assets"] is not None:
+                        channel["assets"][path] = result
+            # Whatever still failed is retried by the next export
+            channel["state"]["deferred"] = {failure["path"]: failure["url"] for failure in failures}
+            channel["state"]["failures"] = len(failures)
+            await self.mgr.save_json(channel["rewrites"], os.path.join(channel["folder"], "rewrites.json"), s3)
+            if channel["assets"] is not None:
+                await self.mgr.save_json(channel["assets"], os.path.join(channel["folder"], "assets.json"), s3)
+                if saved:
+                    await self.rewrite_legacy(channel["folder"], channel["rewrites"], s3)
+            if failures or channel["failures"]:
+                await self.mgr.save_json(failures, os.path.join(channel["folder"], "failures.json"), s3)
+            await self.mgr.save_json(channel["state"], os.path.join(channel["folder"], "state.json"), s3)
+            self.late_manifest.add_channel(channel["name"], channel["folder"], channel["state"]["message_count"], 0,
+                    channel["state"]["last_message_id"], channel["rewrites"].values(), channel["assets"] is not None)
+        self.deferred.clear()
+        await self.mgr.cleaner.flush(s3)
+        if failed:
+            await self.update_status(f"Saved {count - failed}/{count} assets of {self.category.name} in the background, "
+                    "run /export again to retry the others", done=True)
+        else:
+            await self.update_status(f"Saved {count} assets of {self.category.name} in the background", done=True)
+        return True
+
+    async def sync_to_archive(self, manifest: typing.Optional[Manifest] = None):
+        await self.update_status(f"Syncing category {self.category.name} to the archive")
         try:
-            timeout = aiohttp.ClientTimeout(total=10*60)
-            url = urllib.parse.urljoin(config.archive.url, 'update')
-            async with self.mgr.session.post(url, headers=headers, data=body, timeout=timeout) as r:
-                r.raise_for_status()
-                log.debug(f"Archive server replied with {await r.text()}")
+            objects = await self.mgr.sync_to_archive([manifest or self.manifest])
         except Exception as e:
             log.exception(f"Failed to sync category {self.category.name} to the archive")
             await self.update_status(f"Failed to sync category {self.category.name} to the archive: {e}", done=True)
             raise
 
-        await self.update_status(f"Synced category {self.category.name} to the archive", done=True)
\ No newline at end of file
+        await self.update_status(f"Synced category {self.category.name} to the archive ({objects} changed objects)", done=True)
\ No newline at end of file